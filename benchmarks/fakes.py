@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Stand-ins for ssh, scp, sbt, curl, apt-get and service used by benchmarks/orchestration.py.
+# Usage: fakes.py <tool> [args...]
+# Every call is appended to $BENCH_DIR/calls. Tools sleep $BENCH_LATENCY_<TOOL>
+# seconds and fail with probability $BENCH_FAILURE_<TOOL>, e.g. BENCH_LATENCY_APT_GET=0.5.
+# sbt additionally sleeps $BENCH_LATENCY_SBT_TASK seconds per task.
+# ssh plays the target side: version answers $BENCH_SCRIPT_VERSION $BENCH_INVENTORY_HASH, run-plan and
+# restart call the apt-get and service fakes the way deploy-target.py would,
+# debs sent by deploy.py --distribute are read and dropped.
+
+import json, os, random, subprocess, sys, time
+
+
+def _env(name, tool, default=0.0):
+    return float(os.environ.get("BENCH_{}_{}".format(name, tool.upper().replace("-", "_")), default))
+
+
+def _record(tool):
+    line = json.dumps({"tool": tool, "remote": "BENCH_REMOTE" in os.environ, "time": time.time()}) + "\n"
+    # a single short O_APPEND write, so concurrent calls do not interleave
+    fd = os.open(os.path.join(os.environ["BENCH_DIR"], "calls"), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+def _failed(tool):
+    return random.random() < _env("FAILURE", tool)
+
+
+def _remote(args):
+    env = dict(os.environ)
+    env["BENCH_REMOTE"] = "1"
+    return subprocess.call(args, env = env, stdout = sys.stderr)
+
+
+def _modules(cmd):
+    words = cmd.split()
+    return words[words.index("-m") + 1:] if "-m" in words else []
+
+
+def ssh(args):
+    if _failed("ssh"):
+        print("ssh: connect to host {} port 22: Connection timed out".format(args[-2]), file=sys.stderr)
+        return 255
+    cmd = args[-1]
+    if "deploy-target.py version" in cmd:
+        print(os.environ.get("BENCH_SCRIPT_VERSION", "1"), os.environ.get("BENCH_INVENTORY_HASH", "-"))
+    elif "deploy-target.py run-plan" in cmd:
+        return _run_plan(json.load(sys.stdin)["steps"])
+    elif "tar -C" in cmd and "-xf -" in cmd and "| ssh" not in cmd:
+        sys.stdin.buffer.read()
+    elif "deploy-target.py restart" in cmd:
+        action = cmd.split("-a ", 1)[1].split()[0] if "-a " in cmd else "restart"
+        for m in _modules(cmd):
+            if _remote(["service", m, action]) != 0:
+                return 1
+    return 0
+
+
+def _run_plan(steps):
+    for (i, step) in enumerate(steps):
+        start = time.time()
+        if step["op"] == "update":
+            exit_code = _remote(["apt-get", "update"])
+        elif step["op"] == "install" and step.get("debs"):
+            exit_code = _remote(["apt-get", "install", "-y"] + sorted(step["debs"].values()))
+        elif step["op"] == "install":
+            exit_code = _remote(["apt-get", "install", "-y"] + step["modules"])
+        elif step["op"] in ["restart", "check"]:
+            action = step.get("action", "status")
+            exit_code = max([_remote(["service", m, action]) for m in step["modules"]] + [0])
+        else:
+            exit_code = 1
+        print(json.dumps({"step": i, "op": step["op"], "exit_code": exit_code, "duration": time.time() - start}), flush=True)
+        if exit_code != 0:
+            return 1
+    return 0
+
+
+def sbt(args):
+    print("[info] Loading project definition")
+    print("[info] set current project to bench", flush=True)
+    for a in args:
+        if a.startswith("project") or a.startswith("set "):
+            print("[info] {}".format(a))
+            continue
+        time.sleep(_env("LATENCY", "sbt_task"))
+        if _failed("sbt"):
+            print("[error] Total time: 0 s, completed", flush=True)
+            return 1
+        print("[success] Total time: 0 s, completed", flush=True)
+    return 0
+
+
+def generic(tool, args):
+    if _failed(tool):
+        print("{}: simulated failure".format(tool), file=sys.stderr)
+        return 1
+    return 0
+
+
+tool = sys.argv[1]
+args = sys.argv[2:]
+_record(tool)
+time.sleep(_env("LATENCY", tool))
+if tool == "ssh":
+    sys.exit(ssh(args))
+elif tool == "sbt":
+    sys.exit(sbt(args))
+else:
+    sys.exit(generic(tool, args))
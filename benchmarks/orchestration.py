@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Measures deploy.py orchestration offline. ssh, scp, sbt, curl, apt-get and service
+# are replaced by benchmarks/fakes.py, the topology by synthetic inventories.
+# Prints wall time, ssh round trips and process spawns per command and host count.
+#   benchmarks/orchestration.py --hosts 1 10 100 --latency ssh=0.05 --latency apt-get=0.5 --failure ssh=0.01
+
+import argparse, hashlib, json, os, shutil, subprocess, sys, tempfile, time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fakes = os.path.join(root, "benchmarks", "fakes.py")
+tools = ["ssh", "scp", "sbt", "curl", "apt-get", "service"]
+
+sys.path.insert(0, root)
+from deployutils import COMPANY_NAME, SCRIPT_VERSION
+
+
+def _commands(parallel, distribute):
+    p = str(parallel)
+    d = ["--distribute"] if distribute else []
+    return {
+        "install": ["install", "-g", "all", "-e", "dev", "-p", p] + d,
+        "chick": ["chick", "-g", "all", "-e", "dev", "-b", "-f", "--no-docs", "-p", p] + d,
+        "restartcluster": ["restartcluster", "-e", "dev", "-p", p],
+        "publish": ["publish", "-g", "all", "-e", "dev", "-b", "-f", "--no-docs"],
+    }
+
+
+def _inventory(hosts, modules):
+    # m0 is the seed module, carried by every tenth host. The other modules
+    # are spread over the hosts round robin.
+    names = ["m{}".format(i) for i in range(max(modules, 2))]
+    servers = []
+    for i in range(hosts):
+        host_modules = [names[1 + i % (len(names) - 1)]]
+        if i % 10 == 0:
+            host_modules.insert(0, names[0])
+        servers.append({"host": "backend{:03d}.bench".format(i), "modules": host_modules})
+    return {"modules": names, "groups": {"seed": [names[0]]}, "environments": {"dev": servers}}
+
+
+def _workspace(hosts, modules, deb_size):
+    work = tempfile.mkdtemp(prefix="deploy-bench-")
+    bin_dir = os.path.join(work, "bin")
+    os.makedirs(bin_dir)
+    for tool in tools:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as fout:
+            fout.write("#!/bin/sh\nexec {} {} {} \"$@\"\n".format(sys.executable, fakes, tool))
+        os.chmod(path, 0o755)
+    inventory = _inventory(hosts, modules)
+    for m in inventory["modules"]:
+        os.makedirs(os.path.join(work, m, "target"))
+        with open(os.path.join(work, m, "target", "{}-{}_1.0_all.deb".format(COMPANY_NAME, m)), 'wb') as fout:
+            fout.write(os.urandom(int(deb_size * 1e6)))
+    with open(os.path.join(work, "inventory.json"), 'w') as fout:
+        json.dump(inventory, fout)
+    os.makedirs(os.path.join(work, "tmp"))
+    return work
+
+
+def _run(command, argv, hosts, args):
+    work = _workspace(hosts, args.modules, args.deb_size)
+    env = dict(os.environ)
+    env.update({
+        "PATH": os.path.join(work, "bin") + os.pathsep + env.get("PATH", ""),
+        "DEPLOY_INVENTORY": os.path.join(work, "inventory.json"),
+        "DEPLOY_TMP_DIR": os.path.join(work, "tmp"),
+        "DEPLOY_LOCK_DIR": os.path.join(work, "tmp", "locks"),
+        "BENCH_DIR": work,
+        "BENCH_SCRIPT_VERSION": str(SCRIPT_VERSION),
+        "BENCH_INVENTORY_HASH": _file_hash(os.path.join(work, "inventory.json")),
+    })
+    for (name, values) in [("LATENCY", args.latency), ("FAILURE", args.failure)]:
+        for (tool, value) in values:
+            env["BENCH_{}_{}".format(name, tool.upper().replace("-", "_"))] = value
+
+    start = time.time()
+    with open(os.path.join(work, "output"), 'w') as out:
+        exit_code = subprocess.call([sys.executable, os.path.join(root, "deploy.py")] + argv,
+            cwd = work, env = env, stdin = subprocess.DEVNULL, stdout = out, stderr = subprocess.STDOUT)
+    wall = time.time() - start
+
+    calls = {}
+    remote = 0
+    if os.path.exists(os.path.join(work, "calls")):
+        with open(os.path.join(work, "calls"), 'r') as fin:
+            for line in fin:
+                call = json.loads(line)
+                if call["remote"]:
+                    remote += 1
+                else:
+                    calls[call["tool"]] = calls.get(call["tool"], 0) + 1
+    result = {"command": command, "hosts": hosts, "exit_code": exit_code, "wall": wall,
+              "ssh": calls.get("ssh", 0) + calls.get("scp", 0), "spawns": sum(calls.values()),
+              "remote": remote, "calls": calls, "workspace": work}
+    if args.keep or exit_code != 0:
+        print("workspace of {} on {} hosts kept at {}".format(command, hosts, work), file=sys.stderr)
+    else:
+        shutil.rmtree(work)
+    return result
+
+
+def _file_hash(path):
+    with open(path, 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def _tool_value(value):
+    (tool, _, number) = value.partition("=")
+    # sbt_task is not an executable, but its latency is read by the sbt fake
+    if tool not in tools + ["sbt_task"] or not number:
+        raise argparse.ArgumentTypeError("expected TOOL=NUMBER with TOOL one of {}".format(", ".join(tools + ["sbt_task"])))
+    float(number)
+    return (tool, number)
+
+
+parser = argparse.ArgumentParser(description = "deploy.py orchestration benchmark")
+parser.add_argument("--hosts", type=int, nargs="+", default=[1, 10, 50, 200, 500], help = "host counts of the synthetic inventories")
+parser.add_argument("--modules", type=int, default=5, help = "number of modules in the inventories")
+parser.add_argument("-c", "--commands", nargs="+", default=["install", "chick", "restartcluster", "publish"],
+    choices=["install", "chick", "restartcluster", "publish"])
+parser.add_argument("-p", "--parallel", type=int, default=8, help = "value of deploy.py --parallel")
+parser.add_argument("--latency", type=_tool_value, action="append", default=[], metavar="TOOL=SEC",
+    help = "delay of every call of a fake tool, sbt_task is the delay of each sbt task")
+parser.add_argument("--failure", type=_tool_value, action="append", default=[], metavar="TOOL=RATE",
+    help = "probability that a call of a fake tool fails, ssh fails with exit code 255")
+parser.add_argument("--distribute", action="store_true", help = "run install and chick with --distribute")
+parser.add_argument("--deb-size", dest="deb_size", type=float, default=1, metavar="MB", help = "size of the fake debs")
+parser.add_argument("--json", dest="json", help = "also write the results to this file")
+parser.add_argument("--keep", action="store_true", help = "keep workspaces with fake logs and call records")
+args = parser.parse_args()
+
+results = []
+print("{:<16} {:>6} {:>9} {:>6} {:>8} {:>8} {:>5}".format("command", "hosts", "wall", "ssh", "spawns", "remote", "exit"))
+for hosts in args.hosts:
+    for command in args.commands:
+        r = _run(command, _commands(args.parallel, args.distribute)[command], hosts, args)
+        results.append(r)
+        print("{:<16} {:>6} {:>8.2f}s {:>6} {:>8} {:>8} {:>5}".format(
+            r["command"], r["hosts"], r["wall"], r["ssh"], r["spawns"], r["remote"], r["exit_code"]), flush=True)
+
+if args.json:
+    with open(args.json, 'w') as fout:
+        json.dump(results, fout, indent=2)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Measures how long deploy.py takes to print help and to answer a tab completion.
+# Exits non-zero when the slowest of them exceeds the budget.
+
+import argparse, importlib.util, os, subprocess, sys, tempfile, time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(root, "deploy.py")
+
+
+def _time(cmd, env, runs):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        subprocess.run(cmd, env = env, cwd = root, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def _completion_env(line):
+    env = dict(os.environ)
+    env.update({"_ARGCOMPLETE": "1", "COMP_LINE": line, "COMP_POINT": str(len(line)), "COMP_TYPE": "9",
+        "_ARGCOMPLETE_IFS": "\n", "_ARGCOMPLETE_STDOUT_FILENAME": os.path.join(tempfile.gettempdir(), "deploy-completion.out")})
+    return env
+
+
+def _top_imports(top):
+    out = subprocess.run([sys.executable, "-X", "importtime", script, "-h"], cwd = root,
+        stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        (own, cumulative, name) = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), int(own), name.rstrip()))
+    for (cumulative, own, name) in sorted(rows, reverse = True)[:top]:
+        print("  {:>8.1f}ms {:>8.1f}ms {}".format(cumulative / 1000.0, own / 1000.0, name))
+
+
+parser = argparse.ArgumentParser(description = "deploy.py startup benchmark")
+parser.add_argument("--budget", type=float, default=150, metavar="MS", help = "fail if a run takes longer")
+parser.add_argument("--runs", type=int, default=5, help = "take the best of N runs")
+parser.add_argument("--top", type=int, default=10, help = "number of imports to show")
+args = parser.parse_args()
+
+results = [
+    ("deploy.py -h", _time([sys.executable, script, "-h"], os.environ, args.runs)),
+    ("deploy.py install -h", _time([sys.executable, script, "install", "-h"], os.environ, args.runs)),
+]
+# without argcomplete deploy.py ignores the completion environment and only
+# times an argparse error
+if importlib.util.find_spec("argcomplete"):
+    results.append(("complete 'deploy.py install -m '", _time([sys.executable, script], _completion_env("deploy.py install -m "), args.runs)))
+else:
+    print("argcomplete is not installed, skipping the completion run")
+for (name, duration) in results:
+    print("{:<36} {:>8.1f}ms".format(name, duration * 1000))
+print("slowest imports (cumulative, self):")
+_top_imports(args.top)
+
+slowest = max(duration for (_, duration) in results) * 1000
+if slowest > args.budget:
+    print("over budget: {:.1f}ms > {:.1f}ms".format(slowest, args.budget))
+    sys.exit(1)
@@ -16,44 +16,451 @@
 # limitations under the License.
 
 import subprocess
+import hashlib
+import json
+import os
+import re
+import socket
+import socketserver
+import threading
 import time
+import urllib.error
+import urllib.request
+from concurrent import futures
 from deployutils import *
 
+sources_list = "/etc/apt/sources.list.d/{}.list".format(COMPANY_NAME)
+state_dir = "/var/lib/{}-deploy".format(COMPANY_NAME)
+debs_dir = "/var/cache/{}-deploy/debs".format(COMPANY_NAME)
+
+# (step, duration) or (step, duration, module) of the current command, reported by run-plan
+_timings = []
+_print_lock = threading.Lock()
+
 
 def install(args):
+    if args.debs:
+        _install_local(args.debs)
+    else:
+        _install(args.modules, args.version)
+
+
+def _install(modules, version=None, out=None, debs=None):
+    if debs:
+        return _install_local([debs[m] for m in modules], out)
+    if version:
+        return _install_debs(modules, version, out)
     #print("installing {}".format(args.modules))
     cmd = ["apt-get", "install",  "-y", "--force-yes"]
-    cmd.extend(args.modules)
-    subprocess.call(cmd)
+    cmd.extend(modules)
+    return _timed("apt-get install", lambda: subprocess.call(cmd, stdout=out), out)
+
+
+def _install_debs(modules, version, out=None):
+    # installs the given version of the modules by downloading their debs
+    # straight from the company repo, so no package index is needed
+    debs = []
+    for m in modules:
+        path = os.path.join(debs_dir, DEB_FILE.format(name=m, version=version))
+        if not os.path.exists(path):
+            url = _company_sources()[0][0] + DEB_POOL_PATH.format(initial=m[0], name=m, version=version)
+            _timed("download {}".format(m), lambda: _download(url, path), out)
+        debs.append(path)
+    return _deb_install(debs, out)
+
+
+def _install_local(paths, out=None):
+    # installs deb files, relative paths are relative to the directory of
+    # this script. Debs sent by deploy.py --distribute are removed once installed.
+    base = os.path.dirname(os.path.abspath(__file__))
+    debs = [os.path.join(base, p) for p in paths]
+    exit_code = _deb_install(debs, out)
+    if exit_code == 0:
+        for d in debs:
+            if os.path.dirname(d) == os.path.join(base, DEBS_DIST_DIR):
+                os.remove(d)
+    return exit_code
+
+
+def _deb_install(debs, out=None):
+    # apt-get resolves the dependencies of deb files given by absolute path and
+    # fails if it cannot install them, unlike dpkg -i followed by apt-get -f,
+    # which may remove the module instead. Older versions are installed too.
+    cmd = ["apt-get", "install", "-y", "--allow-downgrades"] + [os.path.abspath(d) for d in debs]
+    return _timed("deb install", lambda: subprocess.call(cmd, stdout=out), out)
+
+
+def _download(url, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}".format(path, os.getpid())
+    with urllib.request.urlopen(url, timeout=60) as response, open(tmp, 'wb') as fout:
+        while True:
+            chunk = response.read(1 << 20)
+            if not chunk:
+                break
+            fout.write(chunk)
+    os.replace(tmp, path)
 
 
 def update(args):
+    _update(args.full)
+
+
+def _update(full, out=None):
     #print("running apt-get update")
-    if args.full:
-        subprocess.call(["apt-get", "update"])
+    if full:
+        return _timed("apt-get update", lambda: subprocess.call(["apt-get", "update"], stdout=out), out)
     else:
-        source = 'Dir::Etc::sourcelist=/etc/apt/sources.list.d/{}.list'.format(COMPANY_NAME)
-        subprocess.call(["apt-get", "update", '-o', source, '-o', 'Dir::Etc::sourceparts=-', '-o', 'APT::Get::List-Cleanup="0"'])
+        # the index of the company repo is refreshed only when its Release
+        # file changed since the last successful update
+        releases = _timed("release check", _release_hashes, out)
+        state_file = os.path.join(state_dir, "releases.json")
+        try:
+            with open(state_file, 'r') as fin:
+                known = json.load(fin)
+        except (IOError, ValueError):
+            known = None
+        if releases and releases == known:
+            print("company repo did not change, skipping apt-get update", file=out or sys.stdout)
+            return 0
+        source = 'Dir::Etc::sourcelist={}'.format(sources_list)
+        exit_code = _timed("apt-get update", lambda: subprocess.call(["apt-get", "update", '-o', source, '-o', 'Dir::Etc::sourceparts=-', '-o', 'APT::Get::List-Cleanup="0"'], stdout=out), out)
+        if exit_code == 0 and releases:
+            os.makedirs(state_dir, exist_ok=True)
+            with open(state_file, 'w') as fout:
+                json.dump(releases, fout)
+        return exit_code
     #subprocess.call(["apt-get", "update"])
 
 
+def _company_sources():
+    # (url, suite) of every deb line in the company sources list
+    sources = []
+    with open(sources_list, 'r') as fin:
+        for line in fin:
+            parts = re.sub(r"\[[^\]]*\]", "", line.split("#")[0]).split()
+            if len(parts) >= 3 and parts[0] == "deb":
+                sources.append((parts[1].rstrip("/") + "/", parts[2]))
+    return sources
+
+
+def _release_hashes():
+    # sha256 of InRelease (or Release) of every company source, None if any
+    # of them can not be fetched
+    hashes = {}
+    try:
+        for (url, suite) in _company_sources():
+            if suite.endswith("/"):
+                base = url + suite
+            else:
+                base = "{}dists/{}/".format(url, suite)
+            for name in ["InRelease", "Release"]:
+                try:
+                    with urllib.request.urlopen(base + name, timeout=10) as response:
+                        hashes[base] = hashlib.sha256(response.read()).hexdigest()
+                    break
+                except urllib.error.HTTPError as e:
+                    if e.code != 404:
+                        raise
+            else:
+                return None
+    except (OSError, ValueError):
+        return None
+    return hashes
+
+
+def _timed(step, fn, out=None):
+    start = time.time()
+    result = fn()
+    duration = time.time() - start
+    _timings.append((step, duration))
+    print("{} took {:.2f} sec".format(step, duration), file=out or sys.stdout)
+    return result
+
+
 def restart(args):
-    print("{}ing {}".format(args.action, args.modules))
-    for m in args.modules:
-        subprocess.call(["sudo", "service", m, args.action])
-        if args.action == "start" or args.action == "restart":
-            time.sleep(3)
+    exit_code = _restart_op(args.modules, args.action)
+    if exit_code != 0:
+        sys.exit(exit_code)
+
+
+def _restart_op(modules, action, out=None):
+    # a module which can not be stopped is most likely not running
+    exit_code = _restart(modules, action, out)
+    return 0 if action == "stop" else exit_code
+
+
+def _restart(modules, action, out=None):
+    # all modules are handled at the same time, except that a module starts
+    # only when the modules it starts after (see start_after in deployutils,
+    # and the seed modules) are ready, and stops only when the modules
+    # starting after it are down
+    print("{}ing {}".format(action, modules), file=out or sys.stdout)
+    order = _restart_order(list(dict.fromkeys(modules)), action)
+    tasks = {}
+    with futures.ThreadPoolExecutor(max_workers=max(len(order), 1)) as executor:
+        for (m, after) in order:
+            tasks[m] = executor.submit(_restart_module, m, action, [tasks[a] for a in after], out)
+    exit_codes = [tasks[m].result() for (m, _) in order if tasks[m].result() != 0]
+    return exit_codes[0] if exit_codes else 0
+
+
+def _print(msg, out=None):
+    # modules are restarted by several threads, their lines must not mix
+    with _print_lock:
+        print(msg, file=out or sys.stdout, flush=True)
+
+
+def _restart_order(modules, action):
+    # [(module, modules to wait for)] where every module comes after the
+    # modules it waits for. Other modules start after the seed modules of the
+    # host as well, unless a seed starts after them.
+    seeds = [m for m in modules if m in topology.seed_modules]
+    after = dict((m, [a for a in start_after.get(m, []) if a in modules]) for m in modules)
+    for m in modules:
+        if m not in seeds:
+            after[m] += [s for s in seeds if s not in after[m] and m not in start_after.get(s, [])]
+    if action == "stop":
+        after = dict((m, [d for d in modules if m in after[d]]) for m in modules)
+    ordered = []
+    while len(ordered) < len(modules):
+        ready = [m for m in modules if m not in ordered and all(a in ordered for a in after[m])]
+        if not ready:
+            raise Exception("start_after of {} has a cycle".format(" ".join(m for m in modules if m not in ordered)))
+        ordered += ready
+    return [(m, after[m]) for m in ordered]
+
+
+def _restart_module(module, action, after, out=None):
+    failed = [a for a in after if a.result() != 0]
+    if failed and action != "stop":
+        _print("not {}ing {}, a module it starts after failed".format(action, module), out)
+        return 1
+    start = time.time()
+    if action == "start" or action == "restart":
+        probe = _probe(module)
+        exit_code = subprocess.call(["sudo", "service", module, action], stdout=out)
+        if exit_code == 0 and not _wait_ready(module, probe, out):
+            exit_code = 1
+        elif exit_code == 0 and module in topology.seed_modules and module not in readiness:
+            _print("waiting {} sec for seed {}".format(SEED_START_DELAY, module), out)
+            time.sleep(SEED_START_DELAY)
+    else:
+        exit_code = subprocess.call(["sudo", "service", module, action], stdout=out)
+    duration = time.time() - start
+    _print("{} {}: exit code {}, {:.1f} sec".format(action, module, exit_code, duration), out)
+    _timings.append(("service-{}".format(action), duration, module))
+    return exit_code
+
+
+def _check(modules, out=None):
+    for m in modules:
+        if not _wait_ready(m, _probe(m), out):
+            return 1
+    return 0
+
+
+def _probe(module):
+    # returns a function telling whether the module is ready, see readiness
+    # in deployutils. It has to be created before the module is started
+    # because log probes only look at lines written after that.
+    conf = readiness.get(module, {"type": "service"})
+    if conf["type"] == "tcp":
+        def probe():
+            try:
+                socket.create_connection((conf.get("host", "localhost"), conf["port"]), timeout=1).close()
+                return True
+            except OSError:
+                return False
+    elif conf["type"] == "http":
+        def probe():
+            try:
+                with urllib.request.urlopen(conf["url"], timeout=2) as response:
+                    return response.status < 400
+            except (OSError, ValueError):
+                return False
+    elif conf["type"] == "log":
+        try:
+            offset = os.path.getsize(conf["path"])
+        except OSError:
+            offset = 0
+        pattern = re.compile(conf["pattern"])
+        def probe():
+            try:
+                with open(conf["path"], 'r', errors="replace") as fin:
+                    fin.seek(offset)
+                    return any(pattern.search(line) for line in fin)
+            except OSError:
+                return False
+    else:
+        def probe():
+            return subprocess.call(["service", module, "status"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    return probe
+
+
+def _wait_ready(module, probe, out=None):
+    timeout = readiness.get(module, {}).get("timeout", READINESS_TIMEOUT)
+    start = time.time()
+    delay = 0.1
+    while not probe():
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            _print("{} is not ready after {:.0f} sec".format(module, elapsed), out)
+            return False
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, 5)
+    _print("{} is ready in {:.1f} sec".format(module, time.time() - start), out)
+    return True
+
+
+def run_plan(args):
+    # executes a json plan read from stdin, e.g.
+    # {"steps": [{"op": "update", "full": false},
+    #            {"op": "install", "modules": ["company-bootstrap"]},
+    #            {"op": "restart", "action": "restart", "modules": ["company-bootstrap"]},
+    #            {"op": "check", "modules": ["company-bootstrap"]}]}
+    # Output of the commands goes to stderr, stdout gets one json result per step.
+    # Execution stops at the first failed step.
+    plan = json.load(sys.stdin)
+    if _run_steps(plan["steps"], sys.stderr, lambda result: print(json.dumps(result), flush=True)) != 0:
+        sys.exit(1)
+
+
+def _run_steps(steps, out, report):
+    # runs plan steps writing their output to out, report(result) is called
+    # after every step. Returns the exit code of the first failed step or 0.
+    ops = {
+        "update": lambda s: _update(s.get("full", False), out),
+        "install": lambda s: _install(s["modules"], s.get("version"), out, s.get("debs")),
+        "restart": lambda s: _restart_op(s["modules"], s["action"], out),
+        "check": lambda s: _check(s["modules"], out),
+    }
+    for (i, step) in enumerate(steps):
+        start = time.time()
+        del _timings[:]
+        try:
+            if step["op"] in ops:
+                exit_code = ops[step["op"]](step)
+            else:
+                print("unknown op {}".format(step["op"]), file=out)
+                exit_code = 1
+        except Exception as e:
+            print("{} failed: {}".format(step["op"], e), file=out)
+            exit_code = 1
+        report({"step": i, "op": step["op"], "exit_code": exit_code, "duration": time.time() - start, "timings": list(_timings)})
+        if exit_code != 0:
+            return exit_code
+    return 0
+
+
+def agent(args):
+    # serves plans like run-plan, without starting python and sudo for every
+    # plan. deploy.py reaches the socket through a forwarding of its ssh
+    # master connection, see _agent in deploy.py. Plans are run one at a time
+    # in the order they arrive, the agent exits after idle seconds without requests.
+    # the topology is kept for the life of the agent, deploy.py compares the
+    # hash of its inventory with its own
+    topology.modules
+    inventory_hash()
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = _AgentServer(args.socket, _AgentHandler)
+    os.chmod(args.socket, 0o600)
+    if "SUDO_UID" in os.environ:
+        # ssh of the deploying user connects to the socket
+        os.chown(args.socket, int(os.environ["SUDO_UID"]), int(os.environ["SUDO_GID"]))
+    server.timeout = 1
+    print("agent {} listening at {}".format(SCRIPT_VERSION, args.socket), flush=True)
+    try:
+        while not args.idle or server.active or time.time() - server.last < args.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, handler):
+        socketserver.UnixStreamServer.__init__(self, path, handler)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_lock = threading.Lock()
+        self.last = time.time()
+
+    def track(self, delta):
+        with self.active_lock:
+            self.active += delta
+            self.last = time.time()
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    # one json request per connection: {"op": "version"} or {"steps": [...]}.
+    # Answers are json lines: {"version": n, "inventory": hash}, or {"output": line} and
+    # {"result": result} while the plan runs, then {"exit_code": n}.
+
+    def handle(self):
+        self.send_lock = threading.Lock()
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        if request.get("op") == "version":
+            self.send({"version": SCRIPT_VERSION, "inventory": inventory_hash()})
+            return
+        self.server.track(1)
+        try:
+            with self.server.lock:
+                exit_code = self.run(request["steps"])
+        finally:
+            self.server.track(-1)
+        self.send({"exit_code": exit_code})
+
+    def run(self, steps):
+        # output of commands goes through a pipe, so that subprocesses can write to it
+        (r, w) = os.pipe()
+        out = os.fdopen(w, 'w', buffering=1)
+
+        def forward():
+            with os.fdopen(r, 'r', errors="replace") as fin:
+                for line in fin:
+                    self.send({"output": line.rstrip("\n")})
+
+        reader = threading.Thread(target=forward)
+        reader.start()
+        try:
+            return _run_steps(steps, out, lambda result: self.send({"result": result}))
+        finally:
+            out.close()
+            reader.join()
+
+    def send(self, message):
+        with self.send_lock:
+            self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+            self.wfile.flush()
 
 def kill_backend(args):
-    #kill -9
+    # SIGTERM first, kill -9 what is still running after the grace period
     print("killing backend")
-    subprocess.call(["sudo", "pkill", "-f", COMPANY_NAME])      
-    time.sleep(1)
-    subprocess.call(["sudo", "pkill", "-9", "-f", COMPANY_NAME])      
+    start = time.time()
+    subprocess.call(["sudo", "pkill", "-f", COMPANY_NAME])
+    delay = 0.05
+    while _running(COMPANY_NAME):
+        elapsed = time.time() - start
+        if elapsed >= args.grace:
+            print("still running after {:.1f} sec, killing with -9".format(elapsed))
+            subprocess.call(["sudo", "pkill", "-9", "-f", COMPANY_NAME])
+            return
+        time.sleep(min(delay, args.grace - elapsed))
+        delay = min(delay * 2, 1)
+    print("backend exited in {:.1f} sec".format(time.time() - start))
+
+
+def _running(pattern):
+    return subprocess.call(["pgrep", "-f", pattern], stdout=subprocess.DEVNULL) == 0
 
 
 def print_version(args):
-    print(SCRIPT_VERSION)
+    print(SCRIPT_VERSION, inventory_hash())
 
 
 
@@ -62,6 +469,8 @@ topParser = argparse.ArgumentParser()
 subParsers = topParser.add_subparsers(title = "Command categories")
 
 installParser = subParsers.add_parser("install", description = "installing backend modules to host", parents=[modulesParser])
+installParser.add_argument("--version", dest="version", help = "install this version of the debs downloaded from the company repo")
+installParser.add_argument("--deb", dest="debs", nargs="+", metavar="PATH", help = "install these deb files instead of modules")
 installParser.set_defaults(func = install)
 
 updateParser = subParsers.add_parser("update", description = "run apt-get update")
@@ -69,11 +478,20 @@ updateParser.add_argument("--full", dest="full", action="store_true", default=Fa
 updateParser.set_defaults(func = update)
 
 killParser = subParsers.add_parser("killbackend", description = "kill all backend modules")
+killParser.add_argument("--grace", dest="grace", type=float, default=1, metavar="SEC", help = "kill -9 modules which are still running after SEC seconds")
 killParser.set_defaults(func = kill_backend)
 
 restartParser = subParsers.add_parser("restart", description = "start, stop backend modules", parents = [modulesParser, actionParser])
 restartParser.set_defaults(func = restart)
 
+runPlanParser = subParsers.add_parser("run-plan", description = "run steps of a json plan read from stdin")
+runPlanParser.set_defaults(func = run_plan)
+
+agentParser = subParsers.add_parser("agent", description = "serve run-plan requests on a unix socket")
+agentParser.add_argument("--socket", dest="socket", default=AGENT_SOCKET, help = "path of the socket")
+agentParser.add_argument("--idle", dest="idle", type=int, default=0, metavar="SEC", help = "exit after SEC seconds without requests, never by default")
+agentParser.set_defaults(func = agent)
+
 versionParser = subParsers.add_parser("version", description = "print script version")
 versionParser.set_defaults(func = print_version)
 
@@ -15,18 +15,117 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import subprocess
 from deployutils import *
-import copy
+from deployutils import _add_module_prefix, _remove_module_prefix, _inventory_file
+import atexit
+import importlib
+import json
+import os
+import threading
 import time
 import re
 import sys
 
+
+class _LazyModule(object):
+    # imports the module on first use. Most commands, and tab completion in
+    # particular, do not need most of the modules below.
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+asyncio = _LazyModule("asyncio")
+base64 = _LazyModule("base64")
+copy = _LazyModule("copy")
+fcntl = _LazyModule("fcntl")
+futures = _LazyModule("concurrent.futures")
+getpass = _LazyModule("getpass")
+glob = _LazyModule("glob")
+hashlib = _LazyModule("hashlib")
+http_client = _LazyModule("http.client")
+socket = _LazyModule("socket")
+shutil = _LazyModule("shutil")
+subprocess = _LazyModule("subprocess")
+tarfile = _LazyModule("tarfile")
+urllib_parse = _LazyModule("urllib.parse")
+zlib = _LazyModule("zlib")
+
 verbose = False
+follow = False
+cmd_timeout = None
 remoteExec = False
 remoteHost = None
-log_file = "/tmp/{}-deploy.log".format(COMPANY_NAME)
+run_id = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+run_log_dir = os.path.join(LOG_DIR, run_id)
+log_file = os.path.join(run_log_dir, "deploy.log")
 log = None
+events_file = os.path.join(LOG_DIR, "events.jsonl")
+events = None
+ssh_mux = True
+# %C does not hash the local user, %i keeps the masters of different users apart
+ssh_control_path = "/tmp/{}-deploy-ssh-%i-%C".format(COMPANY_NAME)
+ssh_persist = 60
+cache_dir = CACHE_DIR
+version_cache_ttl = 0
+ssh_retries = 3
+ssh_retry_delay = 1
+use_agent = False
+# shared cache of compiled modules, see _cache_restore
+build_cache = None
+build_cache_size = BUILD_CACHE_SIZE
+# with --plan commands are recorded instead of being run, see _plan_run
+planning = False
+# run whose journal is written, the current one or the one given with --resume
+journal_id = run_id
+journal = None
+_journal_keep = 50
+
+# per thread state of host workers, see _run_on_hosts
+_local = threading.local()
+_host_logs = set()
+_log_lock = threading.Lock()
+
+# durations of ssh round trips by host, see _report_ssh_timings
+_ssh_timings = {}
+_ssh_timings_lock = threading.Lock()
+
+# (host, module, phase) -> time of the steps done by this run or the resumed
+# one, see _journal, and the steps restored from the resumed one
+_journal_done = {}
+_resumed_steps = set()
+_journal_lock = threading.Lock()
+
+# steps recorded with --plan and the number of workers of every stage of
+# hosts processed in parallel, see _plan_record
+_plan_steps = []
+_plan_stages = [1]
+_plan_lock = threading.Lock()
+
+# host -> local socket forwarded to its agent or None, see _agent
+_agents = {}
+_agent_forwards = []
+_agents_lock = threading.Lock()
+
+# lock held while the run is alive, see _Admission
+_run_lock = None
+_run_lock_guard = threading.Lock()
+admission_poll = 0.5
+
+# hosts and modules the run worked on, see _archive_run
+_run_hosts = set()
+_run_modules = set()
+
+# hosts known to run the current SCRIPT_VERSION, see _check_version
+_current_hosts = set()
+_current_hosts_lock = threading.Lock()
+# host -> answer of `deploy-target.py version` asked ahead, see _check_versions
+_prefetched_versions = {}
+# ssh processes started at the same time by _check_versions
+_version_check_limit = 32
 
 
 def shell(args):
@@ -34,36 +133,82 @@ def shell(args):
 
 
 def copy_scripts(args):
-    _call(["scp", "deployutils.py", "deploy-target.py", "{}:".format(args.target)])
+    _copy_scripts(args.target)
+    _mark_current(args.target)
 
 
-def publish(args):
+def publish(args, on_published=None):
     modules = _extract_modules(args)
     stage = args.env
     if args.target:
-        stage = stages[args.target]
+        stage = topology.stages[args.target]
 
-    _log("will publish {} modules to stage {}".format(modules, stage))
-    if args.clean:
-        _clean()
-    for m in modules:
-        _publish(m, stage)
+    manifest = _load_manifest()
+    states = dict((m, _module_state(m)) for m in modules)
+    if not args.force:
+        unchanged = set(m for m in modules if manifest.get(stage, {}).get(m) == states[m])
+        if unchanged:
+            _log("skipping unchanged modules {}".format(" ".join(sorted(unchanged))))
+        modules = modules - unchanged
 
+    done = set(m for m in modules if _done(None, m, "publish"))
+    if done:
+        _log("skipping modules published before the resume {}".format(" ".join(sorted(done))))
+        modules = modules - done
+
+    _log("will publish {} modules to stage {}".format(modules, stage))
+    cache = _cache_restore(modules, states, args.clean)
+
+    def published(m):
+        _save_manifest(stage, m, states[m])
+        _cache_store(cache, m)
+        _journal(None, m, "publish")
+        if on_published:
+            on_published(m)
+
+    if on_published:
+        for m in sorted(done):
+            on_published(m)
+
+    with _Admission(["repo"] if modules else []):
+        if args.batch:
+            tasks = []
+            if args.clean:
+                tasks += _clean_tasks
+            labels = dict(("publish {}".format(m), m) for m in modules)
+            tasks += [(label, _publish_cmds(m, stage)) for (label, m) in labels.items()]
+            if tasks:
+                _sbt_batch(tasks, lambda label: label in labels and published(labels[label]))
+        else:
+            if args.clean:
+                _clean()
+            for m in modules:
+                _publish(m, stage)
+                published(m)
+
+    _cache_report(cache)
     if not args.no_docs:
       _publish_docs(stage)
+    return modules
 
 
 def publish_docs(args):
     stage = args.env
     if args.target:
-        stage = stages[args.target]
+        stage = topology.stages[args.target]
 
     _log("will publish docs to stage {}".format(stage))
 
-    if args.clean:
-        _clean()
+    if args.batch:
+        tasks = []
+        if args.clean:
+            tasks += _clean_tasks
+        _sbt_batch(tasks + [("compile", ["compile"])])
+    else:
+        if args.clean:
+            _clean()
 
-    _call(["sbt", "compile"])
+        _call(["sbt", "compile"])
 
     _publish_docs(stage)
 
@@ -71,82 +216,211 @@ def publish_docs(args):
 def install(args):
     modules = _extract_modules(args)
     _log("installing {}".format(modules))
-    if args.env == "prod":
+    if args.env == "prod" and not planning:
         if not confirm("Are u really wanna install to prod?"):
             _log("Good buy!")
             sys.exit(0)
 
+    debs = None
+    if args.distribute:
+        debs = _distribute(_install_targets(modules, args), args.fanout)
+
     if args.target:
-        if args.update:
-            _update_target(args.target, args.full_update)
         _log("will install {} to {}".format(modules, args.target))
-        _install(args.target, modules)
+        with _Admission(["host:" + args.target]):
+            _run_plan(args.target, _install_plan(modules, args, debs))
     else:
-        env = environments[args.env]
-        for server in env:
+        targets = _install_targets(modules, args)
 
-            seeds = []
-            if is_seed(server):
-                seeds = list(groups["seed"])
+        def install_server(host):
+            _log("will install {} to {}".format(targets[host], host))
+            _run_plan(host, _install_plan(targets[host], args, debs))
 
-            t_modules = set.intersection(modules, server["modules"] + seeds)
-            if t_modules:
-                if args.update:
-                    _update_target(server["host"], args.full_update)
-                _log("will install {} to {}".format(t_modules, server["host"]))
-                _install(server["host"], t_modules)
+        _run_on_hosts(list(targets), install_server, args.parallel)
 
 
 def chick(args):
-    publish(copy.deepcopy(args))
+    # installs every module on its hosts as soon as it is published, while
+    # the remaining modules are still being built
     args.update = True
-    install(args)
+    modules = _extract_modules(args)
+    if args.env == "prod" and not planning:
+        if not confirm("Are u really wanna install to prod?"):
+            _log("Good buy!")
+            sys.exit(0)
+
+    targets = _install_targets(modules, args)
+    separate_logs = args.parallel > 1
+    pending = dict((h, set()) for h in targets)
+    running = set()
+    results = {}
+    debs = {} if args.distribute else None
+    distributing = []
+    lock = threading.Lock()
+
+    def install_pending(host):
+        while True:
+            with lock:
+                t_modules = pending[host]
+                pending[host] = set()
+                if not t_modules:
+                    running.discard(host)
+                    return
+            _log("will install {} to {}".format(t_modules, host))
+            _run_plan(host, _install_plan(t_modules, args, debs))
+
+    def run(host):
+        (_, error, duration) = _on_host(host, install_pending, separate_logs)
+        with lock:
+            (errors, busy) = results.get(host, ([], 0))
+            results[host] = (errors + [error] if error else errors, busy + duration)
+
+    if separate_logs:
+        for h in targets:
+            _log("log of {} is {}".format(h, _host_log_file(h)))
+
+    start = time.time()
+    _plan_begin_stage(args.parallel)
+    with futures.ThreadPoolExecutor(max_workers=args.parallel) as executor:
+
+        def distribute(m):
+            hosts = dict((h, set([m])) for (h, t_modules) in targets.items() if m in t_modules)
+            try:
+                debs.update(_distribute(hosts, args.fanout))
+            except Exception as e:
+                _log("ERROR: {}".format(e))
+                with lock:
+                    for h in hosts:
+                        (errors, busy) = results.get(h, ([], 0))
+                        results[h] = (errors + [e], busy)
+                return
+            queue(m)
+
+        def on_published(m):
+            if args.distribute:
+                distributing.append(executor.submit(distribute, m))
+            else:
+                queue(m)
+
+        def queue(m):
+            for (host, t_modules) in targets.items():
+                if m not in t_modules:
+                    continue
+                with lock:
+                    pending[host].add(m)
+                    if host in running:
+                        continue
+                    running.add(host)
+                executor.submit(run, host)
+
+        publish(copy.deepcopy(args), on_published)
+        publish_time = time.time() - start
+        # installs queued by distribute have to be submitted before the shutdown
+        futures.wait(distributing)
+    total = time.time() - start
+
+    if not results:
+        _log("nothing was published, skipping install")
+        return
+    summary = [(h, errors[0] if errors else None, busy) for (h, (errors, busy)) in sorted(results.items())]
+    _print_summary(summary)
+    # without the overlap installs start after publish and take as long as
+    # the busiest host (or all hosts one by one without --parallel)
+    busy = [b for (_, _, b) in summary]
+    install_time = max(busy) if separate_logs else sum(busy)
+    _log("publish took {:.1f} sec, installs {:.1f} sec, overlapping them saved ~{:.1f} sec".format(
+        publish_time, install_time, publish_time + install_time - total))
+    failed = [h for (h, error, _) in summary if error]
+    if failed:
+        raise Exception("Failed on hosts: {}".format(" ".join(failed)))
+
+
+def _install_targets(modules, args):
+    # host -> modules of the host to be installed
+    if args.target:
+        return {args.target: set(modules)}
+    return topology.targets(args.env, modules)
 
 
 def restart_cluster(args):
 
-    env = environments[args.env]
-
-    # stop non seed modules
-    for server in env:
-        _check_version(server["host"])
-        modules = [m for m in server["modules"] if not m in groups["seed"]]
-        if modules:
-            _log("will stop {} at {}".format(" ".join(modules), server["host"]))
-            _call(["ssh", "{}".format(server["host"]), "sudo ~/deploy-target.py restart -a stop -m {}".format(" ".join(modules))])
-
-    # stop seed modules
-    for server in env:
-        _check_version(server["host"])
-        modules = [m for m in server["modules"] if m in groups["seed"]]
-        if modules:
-            _log("will stop {} at {}".format(" ".join(modules), server["host"]))
-            _call(["ssh", "{}".format(server["host"]), "sudo ~/deploy-target.py restart -a stop -m {}".format(" ".join(modules))])
-
-    # start seed
-    for server in env:
-        if is_seed(server):
-            _log("starting seed on {}".format(server["host"]))
-            for s in groups["seed"]:
-                _call(["ssh", "{}".format(server["host"]), "sudo ~/deploy-target.py restart -a start -m {}".format(s)])
-
-    # wait for seed start up
-    time.sleep(3)
-
-    # start all other modules
-    for server in env:
-        modules = list(server["modules"])
-        _log("starting {} on {}".format(" ".join(modules), server["host"]))
-        _call(["ssh", "{}".format(server["host"]), "sudo ~/deploy-target.py restart -a start -m {}".format(" ".join(modules))])
-    
+    env = topology.environments[args.env]
+    if args.rolling:
+        phases = _rolling_restart_phases(env, args.batch_size)
+    else:
+        phases = _restart_phases(env)
+
+    parallel = args.parallel or len(env)
+    total = 0
+    for (name, actions) in phases:
+        if not actions:
+            # e.g. the seed phases of an environment without seed modules
+            _log("{}: nothing to do".format(name))
+            continue
+        _log("{}...".format(name))
+
+        def run(host):
+            (action, modules) = actions[host]
+            _log("will {} {} at {}".format(action, " ".join(modules), host))
+            _run_plan(host, [{"op": "restart", "action": action, "modules": modules}])
+
+        start = time.time()
+        results = _run_on_hosts(list(actions), run, parallel)
+        duration = time.time() - start
+        total += duration
+        (host, _, slowest) = max(results, key=lambda r: r[2])
+        _log("{}: {:.1f} sec, critical path {} {:.1f} sec".format(name, duration, host, slowest))
+    _log("restart critical path: {:.1f} sec".format(total))
+
+
+def _restart_phases(env):
+    # seed modules have to be up before any other module starts and go down
+    # after all of them are stopped, which gives four phases. Hosts inside of
+    # a phase do not depend on each other.
+    seed = topology.seed_modules
+    phases = [
+        ("stop non seed modules", [(s["host"], "stop", [m for m in s["modules"] if m not in seed]) for s in env]),
+        ("stop seed modules", [(s["host"], "stop", [m for m in s["modules"] if m in seed]) for s in env]),
+        ("start seed", [(s["host"], "start", list(topology.groups["seed"])) for s in env if topology.is_seed(s["host"])]),
+        ("start all other modules", [(s["host"], "start", [m for m in s["modules"] if m not in seed]) for s in env]),
+    ]
+    return [(name, _phase_actions(actions)) for (name, actions) in phases]
+
+
+def _rolling_restart_phases(env, batch_size):
+    # restarts batch_size hosts at a time while the others keep serving.
+    # Seed hosts go first, so every following batch joins a running seed.
+    seed = topology.seed_modules
+    servers = [s for s in env if topology.is_seed(s["host"])] + [s for s in env if not topology.is_seed(s["host"])]
+    phases = []
+    for i in range(0, len(servers), batch_size):
+        batch = servers[i:i + batch_size]
+        n = i // batch_size + 1
+        stop = [(s["host"], "stop", [m for m in s["modules"] if m not in seed] + [m for m in s["modules"] if m in seed]) for s in batch]
+        start = [(s["host"], "start", _seeds_of(s) + [m for m in s["modules"] if m not in seed]) for s in batch]
+        phases.append(("batch {} stop".format(n), _phase_actions(stop)))
+        phases.append(("batch {} start".format(n), _phase_actions(start)))
+    return phases
+
+
+def _seeds_of(server):
+    if topology.is_seed(server["host"]):
+        return list(topology.groups["seed"])
+    return []
+
+
+def _phase_actions(actions):
+    return dict((host, (action, modules)) for (host, action, modules) in actions if modules)
+
 
 def restart_module(args):
     modules = _extract_modules(args)
     if not modules:
         _log("Please specify at least one module or group")
     _check_version(args.target)
-    for m in modules:
-        _call(["ssh", "{}".format(args.target), "sudo ~/deploy-target.py restart -a {} -m {}".format(args.action, m)])
+    with _Admission(["host:" + args.target]):
+        for m in modules:
+            _remote(args.target, "sudo ~/deploy-target.py restart -a {} -m {}".format(args.action, m))
 
 
 def start(args):
@@ -160,20 +434,389 @@ def start(args):
  
 
 def print_log(args):
-    with open(log_file, 'r') as fin:
-        print(fin.read())
-    
+    if args.stats:
+        _print_stats(args.top)
+        return
+    if args.list:
+        _print_runs(args)
+        return
+    section = args.target or args.module
+    run = _latest_run() if args.run in [None, "latest"] else args.run
+    if section and not args.run and not os.path.isdir(os.path.join(LOG_DIR, run or "")):
+        # the last run with a log of the host or module
+        run = next((e["run"] for e in reversed(_read_index())
+            if _run_matches(e, args) and _section_members(_sections(e["run"]), section)), None)
+        if not run:
+            raise Exception("no run in {} has a log of {}".format(LOG_DIR, section))
+    if not run:
+        raise Exception("no runs in {}".format(LOG_DIR))
+    _print_run_log(run, section)
+
+
+def _print_runs(args):
+    runs = [e for e in _read_index() if _run_matches(e, args)][-args.count:]
+    print("{:<22}  {:<17}  {:>8}  {:<11}  {:<5}  {}".format("run", "start", "time", "result", "env", "command"))
+    for e in runs:
+        print("{:<22}  {:<17}  {:>7.0f}s  {:<11}  {:<5}  {}".format(e["run"], time.strftime("%x %X", time.localtime(e["start"])),
+            e["duration"] or 0, e["result"], e["env"] or "", e["cmd"]))
+
+
+def _sections(run):
+    # section -> [offset, length] of its gzip members in the archive of the run
+    try:
+        with open(os.path.join(LOG_DIR, run + ".sections.json"), 'r') as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return None
+
+
+def _section_members(sections, section):
+    if not section:
+        return (sections or {}).get("", [])
+    return (sections or {}).get(section) or (sections or {}).get(_add_module_prefix(section), [])
+
+
+def _run_matches(entry, args):
+    return ((not args.target or args.target in entry["hosts"])
+        and (not args.module or _add_module_prefix(args.module) in entry["modules"])
+        and (not args.env or args.env == entry["env"])
+        and (not args.failed or entry["result"] != "ok"))
+
+
+def _print_run_log(run, section):
+    # streams the log of the run, or only the section of a host or module,
+    # without reading the rest of the log
+    out = sys.stdout.buffer
+    sys.stdout.flush()
+    run_dir = os.path.join(LOG_DIR, run)
+    if os.path.isdir(run_dir):
+        # not archived yet
+        main = os.path.join(run_dir, "deploy.log")
+        host_log = os.path.join(run_dir, "{}.log".format(section))
+        if section and os.path.exists(host_log):
+            with open(host_log, 'rb') as fin:
+                shutil.copyfileobj(fin, out)
+        if section and os.path.exists(main):
+            with open(main, 'rb') as fin:
+                for line in fin:
+                    m = _log_tag.match(line)
+                    if m and m.group(1).decode("utf-8", "replace") in [section, _add_module_prefix(section)]:
+                        out.write(line)
+        elif os.path.exists(main):
+            with open(main, 'rb') as fin:
+                shutil.copyfileobj(fin, out)
+        out.flush()
+        return
+    sections = _sections(run)
+    if sections is None:
+        raise Exception("no log of run {} in {}".format(run, LOG_DIR))
+    members = _section_members(sections, section)
+    if section and not members:
+        raise Exception("no log of {} in run {}".format(section, run))
+    with open(os.path.join(LOG_DIR, run + ".log.gz"), 'rb') as fin:
+        for (offset, length) in members:
+            fin.seek(offset)
+            z = zlib.decompressobj(31)
+            while length > 0:
+                chunk = fin.read(min(length, 1 << 16))
+                length -= len(chunk)
+                out.write(z.decompress(chunk))
+            out.write(z.flush())
+    out.flush()
+
+
+def _print_stats(top):
+    # aggregates events of all runs, see _event
+    by_phase = {}
+    by_host = {}
+    runs = set()
+    cache_hits = []
+    for e in _read_events():
+        runs.add(e["run"])
+        if e["phase"] == "run":
+            continue
+        if e["phase"] == "build-cache":
+            cache_hits.append(e["hit"])
+        by_phase.setdefault(e["phase"], []).append(e["duration"])
+        if e.get("host"):
+            by_host.setdefault(e["host"], []).append(e["duration"])
+
+    print("{} runs".format(len(runs)))
+    if cache_hits:
+        print("build cache: {} of {} lookups hit, {:.0f}%".format(cache_hits.count(True), len(cache_hits),
+            100.0 * cache_hits.count(True) / len(cache_hits)))
+    for (title, stats) in [("phase", by_phase), ("host", by_host)]:
+        rows = sorted(stats.items(), key=lambda kv: sum(kv[1]), reverse=True)[:top]
+        if not rows:
+            continue
+        width = max(len(title), max(len(k) for (k, _) in rows))
+        print("")
+        print("{}  {:>6}  {:>10}  {:>8}  {:>8}".format(title.ljust(width), "count", "total", "avg", "max"))
+        for (key, durations) in rows:
+            print("{}  {:>6}  {:>10.1f}  {:>8.2f}  {:>8.2f}".format(key.ljust(width), len(durations),
+                sum(durations), sum(durations) / len(durations), max(durations)))
+
+
+def _plan_begin_stage(parallel):
+    # following host steps are run by `parallel` workers
+    if not planning:
+        return
+    with _plan_lock:
+        _plan_stages.append(parallel)
+
+
+def _plan_record(host, kind, label, parts, spawns=1):
+    # parts are (phase, modules) whose durations are estimated from events
+    # of past runs, see _print_plan
+    with _plan_lock:
+        _plan_steps.append({"host": host, "kind": kind, "label": label, "parts": parts,
+            "spawns": spawns, "stage": len(_plan_stages) - 1 if host else None})
+
+
+def _plan_run(cmd, on_line, stdin):
+    # records cmd and answers like a successful run, so the callers go on as usual
+    name = os.path.basename(cmd[0])
+    if name == "ssh" and stdin:
+        steps = json.loads(stdin)["steps"]
+        parts = [("ssh version", [])] + [_plan_step_part(s) for s in steps]
+        label = "run-plan " + "; ".join(" ".join([s.get("action", s["op"])] + s.get("modules", [])) for s in steps)
+        _plan_record(cmd[-2], name, label, parts)
+        for (i, s) in enumerate(steps):
+            if on_line:
+                on_line(json.dumps({"step": i, "op": s["op"], "exit_code": 0, "duration": 0}), "stdout")
+    elif name == "ssh":
+        _plan_record(cmd[-2], name, cmd[-1], [("ssh remote", [])])
+    elif name == "scp":
+        files = cmd[1 + len(_ssh_opts()):-1]
+        _plan_record(cmd[-1].split(":")[0], name, " ".join(os.path.basename(f) for f in files), [("scp", [])])
+    elif name == "sbt":
+        parts = [("sbt-startup", [])]
+        project = []
+        for a in cmd[1:]:
+            if a.startswith("project "):
+                project = [a.split(" ", 1)[1]]
+            elif not a.startswith("set "):
+                parts.append(("sbt-task", project))
+        _plan_record(None, name, " ".join(a for a in cmd[1:] if not a.startswith("set ")), parts)
+        if on_line:
+            on_line("[info] set current project to plan", "stdout")
+            for _ in parts[1:]:
+                on_line("[success] Total time: 0 s", "stdout")
+    else:
+        _plan_record(None, name, " ".join(cmd), [(name, [])])
+    return 0
+
+
+def _plan_step_part(step):
+    if step["op"] == "update":
+        return ("apt-update", [])
+    if step["op"] == "install" and (step.get("debs") or step.get("version")):
+        return ("deb install", [])
+    if step["op"] == "install":
+        return ("apt-install", [])
+    if step["op"] == "restart":
+        return ("service-" + step["action"], step["modules"])
+    return (step["op"], [])
+
+
+# guesses for phases without events in the history, in seconds
+_plan_defaults = {"ssh version": 0.5, "ssh remote": 5, "scp": 1, "sbt-startup": 30, "sbt-task": 60,
+                  "apt-update": 10, "apt-install": 30, "deb install": 10, "service": 10, "distribute": 5, "upload": 1}
+
+
+def _plan_history():
+    # (phase, module) -> durations of all logged runs, module "*" for any
+    history = {}
+    for e in _read_events():
+        phase = e["phase"]
+        if phase == "run" or e.get("exit_code"):
+            continue
+        if phase == "ssh":
+            cmd = e.get("cmd", "")
+            phase = "ssh version" if "deploy-target.py version" in cmd else "ssh plan" if cmd in ["run-plan", "agent"] else "ssh remote"
+        for module in [e.get("module"), "*"]:
+            history.setdefault((phase, module), []).append(e["duration"])
+    return history
+
+
+def _plan_estimate(parts, history, guessed):
+    # sum of the parts, each part is the slowest of its modules
+    total = 0
+    for (phase, modules) in parts:
+        durations = []
+        for m in modules or ["*"]:
+            known = history.get((phase, m)) or history.get((phase, "*"))
+            if known:
+                durations.append(sorted(known)[len(known) // 2])
+            else:
+                guessed.add(phase)
+                durations.append(_plan_defaults.get(phase, _plan_defaults.get(phase.split("-")[0], 1)))
+        total += max(durations)
+    return total
+
+
+def _makespan(durations, workers):
+    # hosts are taken in order by the first free worker, like executor.map does
+    free = [0] * max(workers, 1)
+    for d in durations:
+        i = free.index(min(free))
+        free[i] += d
+    return max(free) if durations else 0
+
+
+def _print_plan():
+    history = _plan_history()
+    guessed = set()
+    for step in _plan_steps:
+        step["estimate"] = _plan_estimate(step["parts"], history, guessed)
+
+    print("plan of `{}`".format(" ".join(sys.argv[1:])))
+    local = [s for s in _plan_steps if s["stage"] is None]
+    stages = []
+    for step in _plan_steps:
+        if step["stage"] is not None and step["stage"] not in stages:
+            stages.append(step["stage"])
+    if local:
+        print("local:")
+        for s in local:
+            print("  {:<5} {:>7.1f} sec  {}".format(s["kind"], s["estimate"], s["label"]))
+
+    parallel_time = sum(s["estimate"] for s in local)
+    for stage in stages:
+        steps = [s for s in _plan_steps if s["stage"] == stage]
+        hosts = []
+        for s in steps:
+            if s["host"] not in hosts:
+                hosts.append(s["host"])
+        workers = _plan_stages[stage]
+        print("{} hosts, {} at a time:".format(len(hosts), workers))
+        busy = []
+        for h in hosts:
+            print("  {}".format(h))
+            for s in steps:
+                if s["host"] == h:
+                    print("    {:<5} {:>7.1f} sec  {}".format(s["kind"], s["estimate"], s["label"]))
+            busy.append(sum(s["estimate"] for s in steps if s["host"] == h))
+        parallel_time += _makespan(busy, workers)
+
+    kinds = [s["kind"] for s in _plan_steps]
+    print("")
+    print("ssh round trips: {}, scp: {}, sbt runs: {}, local processes: {}".format(
+        kinds.count("ssh"), kinds.count("scp"), kinds.count("sbt"), sum(s["spawns"] for s in _plan_steps)))
+    print("estimated time: {:.1f} sec one host after another, {:.1f} sec as planned".format(
+        sum(s["estimate"] for s in _plan_steps), parallel_time))
+    if guessed:
+        print("no history for {}, guessed".format(", ".join(sorted(guessed))))
+
+
+def _version_known(target):
+    with _current_hosts_lock:
+        if target in _current_hosts:
+            return True
+    if _done(target, None, "version"):
+        with _current_hosts_lock:
+            _current_hosts.add(target)
+        return True
+    if _load_version_cache().get(target, 0) > time.time() - version_cache_ttl:
+        with _current_hosts_lock:
+            _current_hosts.add(target)
+        return True
+    return False
+
 
 def _check_version(target):
-    cmd = ["ssh", target, "~/deploy-target.py version"]
-    std = subprocess.check_output(cmd).decode("utf-8")
-    t_version = int(std)
+    if _version_known(target):
+        return
+
+    # "<version> <inventory hash>"
+    output = _prefetched_versions.pop(target, None)
+    std = (output or _remote_output(target, "~/deploy-target.py version")).split()
+    t_version = int(std[0])
     if t_version < SCRIPT_VERSION:
         _log("old version of script at {}, updating...".format(target))
-        _call(["scp", "deployutils.py", "deploy-target.py", "{}:".format(target)])
+        _copy_scripts(target)
     elif t_version > SCRIPT_VERSION:
         _log("target version is newer than local script")
         exit(1)
+    elif std[1:] != [inventory_hash()]:
+        _log("inventory at {} differs, updating...".format(target))
+        _copy_scripts(target, scripts=False)
+    _mark_current(target)
+
+
+def _check_versions(hosts):
+    # asks all hosts whose version is not known yet at once, in one event
+    # loop, so their ssh handshakes overlap even if the hosts are worked on
+    # one after another. The answers are used by _check_version, hosts which
+    # did not answer are asked again there.
+    if planning:
+        return
+    hosts = [h for h in hosts if not _version_known(h)]
+    if len(hosts) < 2:
+        return
+    remote_cmd = "~/deploy-target.py version"
+
+    async def check(host, slots):
+        output = []
+
+        def on_line(line, stream):
+            if stream != "stdout":
+                return False
+            output.append(line)
+            return True
+
+        async with slots:
+            start = time.time()
+            exit_code = await _run_async(_ssh(host, remote_cmd), on_line, tag=host)
+        _record_ssh_time(host, time.time() - start)
+        _event("ssh", start, time.time() - start, exit_code, host=host, cmd=remote_cmd)
+        if exit_code == 0:
+            _prefetched_versions[host] = "".join(output)
+
+    async def check_all():
+        slots = asyncio.Semaphore(_version_check_limit)
+        await asyncio.gather(*[check(h, slots) for h in hosts], return_exceptions=True)
+
+    asyncio.run(check_all())
+
+
+def _copy_scripts(target, scripts=True):
+    # targets need the inventory as well to validate module names
+    if scripts:
+        _call(_scp(target, ["deployutils.py", "deploy-target.py"]))
+    if _inventory_file():
+        _call(_scp(target, [_inventory_file()])[:-1] + ["{}:{}".format(target, inventory_target_name())])
+
+
+def _version_cache_file():
+    # checks of other inventories do not count
+    return os.path.join(cache_dir, "versions-{}-{}.json".format(SCRIPT_VERSION, inventory_hash()[:12]))
+
+
+def _load_version_cache():
+    # host -> time of the last successful check, only used with --version-cache-ttl
+    if version_cache_ttl <= 0:
+        return {}
+    try:
+        with open(_version_cache_file(), 'r') as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return {}
+
+
+def _mark_current(target):
+    _journal(target, None, "version")
+    with _current_hosts_lock:
+        _current_hosts.add(target)
+        if version_cache_ttl <= 0 or planning:
+            return
+        cache = _load_version_cache()
+        cache[target] = time.time()
+        _shared_dir(cache_dir, _shared_mode)
+        tmp = "{}.{}".format(_version_cache_file(), os.getpid())
+        with open(tmp, 'w') as fout:
+            json.dump(cache, fout)
+        os.replace(tmp, _version_cache_file())
 
 
 def _start(module, hostType, hostname):
@@ -185,34 +828,436 @@ def _start(module, hostType, hostname):
 def _extract_modules(args):
     modules = set()
     if hasattr(args, "modules"):
-        for m in args.modules:
-            modules.add(m)
+        modules.update(args.modules)
     if hasattr(args, "groups"):
         for g in args.groups:
-            for m in groups[g]:
-                modules.add(m)
+            modules.update(topology.groups[g])
     return modules
 
 
 def _restart(host, modules, action):
     _check_version(host)
-    _call(["ssh", "{}".format(host),
-        "sudo ~/deploy-target.py restart -a {} -m {}".format(action, " ".join(modules))])
+    _remote(host, "sudo ~/deploy-target.py restart -a {} -m {}".format(action, " ".join(modules)))
     
 
-def _install(host, modules):
-    if(modules):
-        _check_version(host)
-        _log("installing modules {} to {}".format(" ".join(modules), host))
-        _call(["ssh", "{}".format(host), "sudo ~/deploy-target.py install -m {}".format(" ".join(modules))])
+def _install_plan(modules, args, debs=None):
+    # with --version debs are downloaded directly and with --distribute
+    # (module -> path of the deb on the host) they are there already, so the
+    # package index is not needed
+    version = getattr(args, "version", None)
+    steps = []
+    if args.update and not version and not debs:
+        steps.append({"op": "update", "full": args.full_update})
+    if modules:
+        step = {"op": "install", "modules": sorted(modules), "version": version}
+        if debs:
+            step["debs"] = dict((m, debs[m]) for m in modules)
+        steps.append(step)
+        if getattr(args, "restart", False):
+            steps.append({"op": "restart", "action": "restart", "modules": sorted(modules)})
+    return steps
+
+
+def _run_plan(host, steps):
+    # runs all steps in a single ssh session, see run_plan in deploy-target.py.
+    # Steps done before a resume or a dropped connection are not repeated,
+    # except for updates of the package index, see _pending_steps.
+    if not _pending_steps(host, steps):
+        _log("plan at {} was done before the resume".format(host))
+        return []
+    _check_version(host)
+    results = []
+    exit_code = _ssh_retry(host, lambda: _run_plan_once(host, _pending_steps(host, steps), results))
+    if exit_code != 0:
+        raise Exception("Failed to execute plan {} at {}".format(steps, host))
+    return results
+
+
+def _run_plan_once(host, steps, results):
+    # runs the plan through the agent of the host if it has one, else
+    # through run-plan of deploy-target.py
+    if not steps:
+        return 0
+    agent = _agent(host)
+    start = time.time()
+    step_start = [start]
+    exit_code = None
+
+    def on_line(line, stream):
+        if stream != "stdout":
+            return False
+        try:
+            result = json.loads(line)
+        except ValueError:
+            return False
+        on_result(result)
+        return True
+
+    def on_result(result):
+        results.append(result)
+        step = steps[result["step"]]
+        label = " ".join([step["op"]] + step.get("modules", []))
+        _log("{} at {}: exit code {}, {:.1f} sec".format(label, host, result["exit_code"], result["duration"]))
+        _event(_plan_phases.get(step["op"], step["op"]), step_start[0], result["duration"], result["exit_code"],
+            host=host, module=" ".join(step.get("modules", [])) or None)
+        for timing in result.get("timings", []):
+            # (name, duration) or (name, duration, module)
+            (name, duration, module) = (list(timing) + [None])[:3]
+            _log("  {} took {:.2f} sec".format(" ".join([name] + ([module] if module else [])), duration))
+            _event(name, step_start[0], duration, host=host, module=module)
+        if result["exit_code"] == 0:
+            for m in step.get("modules", [None]):
+                _journal(host, m, _step_phase(step))
+        step_start[0] = time.time()
 
+    try:
+        if agent:
+            _log("will run plan {} by the agent of {}".format(steps, host))
+            exit_code = _agent_run(host, agent, steps, on_result)
+        else:
+            cmd = _ssh(host, "sudo ~/deploy-target.py run-plan")
+            _log("will execute {} with plan {}".format(cmd, steps))
+            exit_code = _run(cmd, on_line=on_line, stdin=json.dumps({"steps": steps}), tag=host)
+    finally:
+        _record_ssh_time(host, time.time() - start)
+        _event("ssh", start, time.time() - start, exit_code, host=host, cmd="agent" if agent else "run-plan")
+    return exit_code
+
+
+def _agent(host):
+    # local end of a forwarding of the ssh master connection to the socket
+    # of `deploy-target.py agent` at the host. None if the host runs no
+    # agent of SCRIPT_VERSION and of the current inventory, the plans are run
+    # by separate processes then.
+    # Probing costs two ssh processes per host, so it is done with --agent only.
+    if not use_agent or not ssh_mux:
+        return None
+    with _agents_lock:
+        if host in _agents:
+            return _agents[host]
+        if planning:
+            _agents[host] = None
+    if planning:
+        _plan_record(host, "mux", "forward and cancel the agent socket", [], spawns=2)
+        return None
+    path = os.path.join(TMP_DIR, "{}-deploy-agent-{}-{}.sock".format(COMPANY_NAME, os.getpid(), host))
+    forward = ["-O", "forward", "-L", "{}:{}".format(path, AGENT_SOCKET)]
+    agent = None
+    if subprocess.call(["ssh"] + _ssh_opts() + forward + [host], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+        with _agents_lock:
+            _agent_forwards.append((host, path))
+        versions = []
+        try:
+            _agent_call(path, {"op": "version"}, lambda message: versions.append((message.get("version"), message.get("inventory"))))
+        except (OSError, ValueError):
+            pass
+        if versions == [(SCRIPT_VERSION, inventory_hash())]:
+            agent = path
+        elif versions and versions[0][0] != SCRIPT_VERSION:
+            _log("agent of {} runs version {}, not using it".format(host, versions[0][0]))
+        elif versions:
+            _log("agent of {} was started with another inventory, not using it".format(host))
+    with _agents_lock:
+        _agents[host] = agent
+    return agent
+
+
+def _agent_call(path, request, on_message):
+    # sends a request to an agent, on_message is called with every answer
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(cmd_timeout)
+    with s:
+        s.connect(path)
+        s.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with s.makefile('rb') as fin:
+            for line in fin:
+                on_message(json.loads(line.decode("utf-8")))
+
+
+def _agent_run(host, path, steps, on_result):
+    # returns 255 like ssh if the connection broke, the retry goes without the agent
+    state = {"exit_code": 255}
+    out = _current_log()
+
+    def on_message(message):
+        if "output" in message:
+            _output(message["output"], host, out)
+        elif "result" in message:
+            on_result(message["result"])
+        elif "exit_code" in message:
+            state["exit_code"] = 1 if message["exit_code"] else 0
 
-def _update_target(host, is_full):
-    _check_version(host)
-    if is_full:
-        _call(["ssh", "{}".format(host), "sudo ~/deploy-target.py update --full"])
-    else:
-        _call(["ssh", "{}".format(host), "sudo ~/deploy-target.py update"])
+    try:
+        _agent_call(path, {"steps": steps}, on_message)
+    except (OSError, ValueError) as e:
+        _log("agent of {} failed: {}".format(host, e))
+    if state["exit_code"] == 255:
+        with _agents_lock:
+            _agents[host] = None
+    return state["exit_code"]
+
+
+def _close_agents():
+    for (host, path) in _agent_forwards:
+        forward = ["-O", "cancel", "-L", "{}:{}".format(path, AGENT_SOCKET)]
+        subprocess.call(["ssh"] + _ssh_opts() + forward + [host], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _step_phase(step):
+    # journal phase of a plan step, restart steps are journaled like the
+    # restarts of restart_cluster
+    return step.get("action", step["op"])
+
+
+def _pending_steps(host, steps):
+    pending = []
+    for step in steps:
+        if "modules" in step:
+            modules = [m for m in step["modules"] if not _done(host, m, _step_phase(step))]
+            if modules:
+                pending.append(dict(step, modules=modules))
+        elif step["op"] == "update":
+            if not _update_done(host, steps):
+                pending.append(step)
+        elif not _done(host, None, _step_phase(step)):
+            pending.append(step)
+    # the package index is only refreshed for the installs following it
+    if all(s["op"] == "update" for s in pending):
+        return []
+    return pending
+
+
+def _update_done(host, steps):
+    # the package index is refreshed by every plan of this run. An update of
+    # the resumed run is only kept if the modules installed were published
+    # before it.
+    step = (host, None, "update")
+    if step not in _resumed_steps:
+        return False
+    modules = [m for s in steps if s["op"] == "install" for m in s["modules"]]
+    return all(_journal_done.get((None, m, "publish"), 0) <= _journal_done[step] for m in modules)
+
+
+_plan_phases = {"update": "apt-update", "install": "apt-install"}
+
+
+def _module_state(module):
+    # hashes of everything a published deb of the module depends on
+    return {
+        "sources": _tree_hash(_module_paths(module)),
+        "dependencies": _tree_hash(["build.sbt", "project"], ignore=["target"]),
+        "deb": _deb_hash(module)
+    }
+
+
+def _module_paths(module):
+    paths = [p for p in module_sources.get(module, [_remove_module_prefix(module)]) if os.path.exists(p)]
+    return paths or ["."]
+
+
+def _deb_hash(module):
+    debs = [d for p in _module_paths(module) for d in glob.glob(os.path.join(p, "target", "*.deb"))]
+    return _tree_hash(sorted(debs, key=os.path.getmtime)[-1:])
+
+
+def _tree_hash(paths, ignore=["target", "logs", "__pycache__"]):
+    h = hashlib.sha1()
+    for path in paths:
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = []
+            for (root, dirs, names) in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if d not in ignore and not d.startswith("."))
+                files += [os.path.join(root, n) for n in sorted(names) if not n.startswith(".")]
+        for f in files:
+            h.update(f.encode("utf-8"))
+            with open(f, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(1 << 20), b""):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def _manifest_file():
+    return os.path.join(cache_dir, "publish-manifest.json")
+
+
+def _load_manifest():
+    # stage -> module -> state of the module at its last publish to the stage
+    try:
+        with open(_manifest_file(), 'r') as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_manifest(stage, module, state):
+    if planning:
+        return
+    manifest = _load_manifest()
+    # the deb is built by the publish, so its state is known only now
+    state = dict(state, deb=_deb_hash(module))
+    manifest.setdefault(stage, {})[module] = state
+    _shared_dir(cache_dir, _shared_mode)
+    tmp = "{}.{}".format(_manifest_file(), os.getpid())
+    with open(tmp, 'w') as fout:
+        json.dump(manifest, fout, indent=2)
+    os.replace(tmp, _manifest_file())
+
+
+def _cache_restore(modules, states, clean):
+    # unpacks the outputs of earlier builds of the same sources and dependencies,
+    # possibly in workspaces of other users, so sbt finds them up to date.
+    # Returns module -> (key, paths) of the modules still to be stored.
+    if not build_cache or planning or not modules:
+        return None
+    dependencies = states[next(iter(modules))]["dependencies"]
+    entries = [(None, "build-" + dependencies, ["project/target", "project/project"])]
+    entries += [(m, _cache_key(m, states[m]), [os.path.join(p, "target") for p in _module_paths(m)]) for m in sorted(modules)]
+    cache = {"misses": {}, "hits": 0, "lookups": len(entries)}
+    for (m, key, paths) in entries:
+        start = time.time()
+        try:
+            hit = not clean and _cache_get(key, paths)
+        except (OSError, tarfile.TarError) as e:
+            _log("WARNING: build cache entry of {} is not usable, building it: {}".format(m or "the build definition", e))
+            # sbt has to find no partly restored outputs, and the entry is
+            # stored again after the build
+            for p in paths:
+                shutil.rmtree(p, ignore_errors=True)
+            try:
+                os.remove(_cache_entry(key))
+            except OSError:
+                pass
+            hit = False
+        _event("build-cache", start, time.time() - start, module=m, hit=hit)
+        if hit:
+            cache["hits"] += 1
+        else:
+            cache["misses"][m] = (key, paths)
+    _log("build cache: restored {} of {} entries".format(cache["hits"], len(entries)))
+    return cache
+
+
+# the users sharing build_cache are expected to share the group of its
+# directory, see BUILD_CACHE_DIR
+_build_cache_mode = 0o2775
+
+
+def _cache_key(module, state):
+    return hashlib.sha1(json.dumps([module, state["sources"], state["dependencies"]]).encode("utf-8")).hexdigest()
+
+
+def _cache_entry(key):
+    return os.path.join(build_cache, "objects", key[-2:], key + ".tar")
+
+
+def _cache_get(key, paths):
+    try:
+        fin = open(_cache_entry(key), 'rb')
+    except IOError:
+        return False
+    with fin:
+        # entries are evicted least recently used first
+        try:
+            os.utime(fin.fileno())
+        except OSError:
+            pass
+        for p in paths:
+            shutil.rmtree(p, ignore_errors=True)
+        with tarfile.open(fileobj=fin) as tar:
+            # every user can write the cache, so an entry must not reach
+            # beyond the target dirs it was stored for, neither by its names
+            # nor by its links
+            def inside(name):
+                name = os.path.normpath(name)
+                return any(name == p or name.startswith(p + os.sep) for p in map(os.path.normpath, paths))
+
+            members = tar.getmembers()
+            for member in members:
+                link = None
+                if member.islnk():
+                    link = member.linkname
+                elif member.issym():
+                    link = os.path.join(os.path.dirname(member.name), member.linkname)
+                if not inside(member.name) or (link is not None and (os.path.isabs(member.linkname) or not inside(link))):
+                    raise tarfile.TarError("{} is outside of {}".format(member.name, " ".join(paths)))
+            # the data filter of tarfile, where there is one, also drops
+            # device files and unsafe modes
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(".", members=members, filter="data")
+            else:
+                tar.extractall(".", members=members)
+    return True
+
+
+def _cache_store(cache, module):
+    # build outputs are complete once the module is published, the build
+    # definition once any module is
+    if cache is None:
+        return
+    for m in [None, module]:
+        if m not in cache["misses"]:
+            continue
+        (key, paths) = cache["misses"].pop(m)
+        entry = _cache_entry(key)
+        if os.path.exists(entry):
+            continue
+        start = time.time()
+        tmp = "{}.{}".format(entry, os.getpid())
+        try:
+            _shared_dir(os.path.dirname(entry), _build_cache_mode)
+            with tarfile.open(tmp, 'w') as tar:
+                for p in paths:
+                    if os.path.exists(p):
+                        tar.add(p)
+            os.chmod(tmp, 0o664)
+            os.replace(tmp, entry)
+        except (OSError, tarfile.TarError) as e:
+            # the module is published already, only the next build is slower
+            _log("WARNING: could not store {} in the build cache: {}".format(m or "the build definition", e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            continue
+        _event("build-cache-store", start, time.time() - start, module=m, size=os.path.getsize(entry))
+
+
+def _cache_evict():
+    # drops least recently used entries until the cache fits into build_cache_size GB
+    entries = []
+    for path in glob.glob(os.path.join(build_cache, "objects", "*", "*.tar")):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    size = sum(e[1] for e in entries)
+    evicted = []
+    for (_, entry_size, path) in sorted(entries):
+        if size <= build_cache_size * 1e9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # evicted by a concurrent build
+            continue
+        size -= entry_size
+        evicted.append(entry_size)
+    return (len(entries) - len(evicted), size, evicted)
+
+
+def _cache_report(cache):
+    if cache is None:
+        return
+    (count, size, evicted) = _cache_evict()
+    _log("build cache: {} hits, {} misses, hit rate {:.0f}%, {} entries of {:.1f} MB, evicted {} entries of {:.1f} MB".format(
+        cache["hits"], cache["lookups"] - cache["hits"], 100.0 * cache["hits"] / cache["lookups"], count, size / 1e6,
+        len(evicted), sum(evicted) / 1e6))
+
+
+_clean_tasks = [("clean", ["clean"]), ("update", ["update"])]
 
 
 def _clean():
@@ -223,70 +1268,1093 @@ def _clean():
 
 def _publish(module, stage):
     _log("publishing module {}".format(module))
-    _call(["sbt", "project {}".format(module), "set debRepoStage := \"{}\"".format(stage), "publishDebs"])
+    _call(["sbt"] + _publish_cmds(module, stage), module=module)
+
+
+def _publish_cmds(module, stage):
+    return ["project {}".format(module), "set debRepoStage := \"{}\"".format(stage), "publishDebs"]
+
 
+_sbt_ready = re.compile(r"set current project to")
+_sbt_task_done = re.compile(r"\[(success|error)\] Total time")
+_ansi_escape = re.compile(r"\x1b\[[0-9;]*m")
 
-_base_docs_url = "http://doc.{}/docs/{}/"
+
+def _sbt_batch(tasks, on_done=None):
+    # runs all tasks in a single sbt session. tasks is a list of (label, commands)
+    # where the commands of every task end with exactly one sbt task, so
+    # sbt prints one "Total time" line per label and we can time each of them.
+    # on_done(label) is called as soon as a task succeeded.
+    cmd = ["sbt"]
+    for (_, commands) in tasks:
+        cmd += commands
+    _log("will execute {}".format(cmd))
+
+    start = time.time()
+    state = {"last": None}
+    timings = []
+
+    def on_line(line, stream):
+        plain = _ansi_escape.sub("", line)
+        last = state["last"]
+        if last is None and _sbt_ready.search(plain):
+            state["last"] = time.time()
+            _log("sbt started in {:.1f} sec".format(state["last"] - start))
+            _event("sbt-startup", start, state["last"] - start)
+        elif _sbt_task_done.search(plain) and len(timings) < len(tasks):
+            now = time.time()
+            label = tasks[len(timings)][0]
+            timings.append((label, now - (last or start)))
+            _log("{} took {:.1f} sec".format(label, timings[-1][1]))
+            module = label.split(" ", 1)[1] if label.startswith("publish ") else None
+            _event("sbt-task", last or start, now - (last or start), 0 if "[success]" in plain else 1, module=module, task=label)
+            state["last"] = now
+            if on_done and "[success]" in plain:
+                on_done(label)
+        return False
+
+    exit_code = _run(cmd, on_line=on_line, tag="sbt")
+    _event("sbt", start, time.time() - start, exit_code, cmd=" ".join(cmd))
+    if exit_code != 0:
+        raise Exception("Failed to execute cmd: {}".format(cmd))
+    return timings
+
+
+docs_url = "http://doc.{}/docs/".format(DOMAIN)
 _doc_user=""
 _doc_password=""
 def _publish_docs(stage):
     _log("publishing docs to {}".format(stage))
+    base_url = "{}{}/".format(docs_url, stage)
     try:
+        uploads = []
         for schema in ["v1.api.json"]:
-                url = _base_docs_url.format(DOMAIN, stage) + schema
+                url = base_url + schema
 
                 latest_schema = re.sub("v[\d]+", "latest", schema)
-                latest_url = _base_docs_url.format(DOMAIN, stage) + latest_schema
+                latest_url = base_url + latest_schema
 
                 schemaPath = "schema/schemas/generated/{}".format(schema)
-                _call(["curl", "--user", "{}:{}".format(_doc_user, _doc_password), "-T", schemaPath, url])
-                _call(["curl", "--user", "{}:{}".format(_doc_user, _doc_password), "-T", schemaPath, latest_url])
+                uploads += [(schemaPath, url), (schemaPath, latest_url)]
 
                 #_call(["asciidoctor", "-o", "api.html", "api.ad"])
-                #_call(["curl", "--user", "{}:{}".format(_doc_user, _doc_password), "-T", "api.html", _base_docs_url.format(stage)])
+                #uploads.append(("api.html", base_url + "api.html"))
 
-                _call(["curl", "--user", "{}:{}".format(_doc_user, _doc_password), "-T", "api_changes.md", _base_docs_url.format(stage)])
+        uploads.append(("api_changes.md", base_url + "api_changes.md"))
+
+        with _Admission(["docs"]), futures.ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+            for f in [executor.submit(_upload, path, url) for (path, url) in uploads]:
+                f.result()
     except Exception as e:
         _log("ERROR: {}".format(e))
         _log("docs was not published!")
         pass
 
 
+# idle keep-alive connections by (scheme, host), see _upload
+_http_pool = {}
+_http_pool_lock = threading.Lock()
+
+
+def _upload(path, url):
+    # PUTs the file to url unless the server already has the same content,
+    # which is checked by comparing the checksum headers of a HEAD request
+    if planning:
+        _plan_record(None, "http", "upload {} to {}".format(path, url), [("upload", [])], 0)
+        return True
+    with open(path, 'rb') as fin:
+        body = fin.read()
+    md5 = hashlib.md5(body)
+    checksums = set([md5.hexdigest(), hashlib.sha1(body).hexdigest(), base64.b64encode(md5.digest()).decode("ascii")])
+    headers = {}
+    if _doc_user:
+        credentials = "{}:{}".format(_doc_user, _doc_password).encode("utf-8")
+        headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode("ascii")
+
+    start = time.time()
+    response = _http_request("HEAD", url, headers=headers)
+    remote = set(response.getheader(h, "").strip('"') for h in ["ETag", "Content-MD5", "X-Checksum-Md5", "X-Checksum-Sha1"])
+    if response.status == 200 and checksums & remote:
+        _log("{} is up to date".format(url))
+        _event("upload", start, time.time() - start, 0, cmd="HEAD " + url)
+        return False
+
+    response = _http_request("PUT", url, body=body, headers=headers)
+    _event("upload", start, time.time() - start, 0 if response.status < 300 else response.status, cmd="PUT " + url)
+    if response.status >= 300:
+        raise Exception("Failed to upload {} to {}: {} {}".format(path, url, response.status, response.reason))
+    _log("uploaded {} to {} in {:.1f} sec".format(path, url, time.time() - start))
+    return True
+
+
+def _http_request(method, url, body=None, headers={}):
+    parts = urllib_parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _http_pool_lock:
+        idle = _http_pool.setdefault(key, [])
+        conn = idle.pop() if idle else None
+    # a pooled connection can be closed by the server in the meantime, then
+    # the request is retried once over a new connection
+    for attempt in range(2):
+        if conn is None:
+            if parts.scheme == "https":
+                conn = http_client.HTTPSConnection(parts.netloc, timeout=60)
+            else:
+                conn = http_client.HTTPConnection(parts.netloc, timeout=60)
+        try:
+            conn.request(method, parts.path or "/", body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            break
+        except (http_client.HTTPException, ConnectionError):
+            conn.close()
+            conn = None
+            if attempt:
+                raise
+    with _http_pool_lock:
+        _http_pool[key].append(conn)
+    return response
+
+
+
+def _ssh_opts():
+    if not ssh_mux:
+        return []
+    # the first connection to a host becomes a master which is shared by all
+    # following ssh/scp/rsync calls and stays alive for ssh_persist seconds
+    return ["-o", "ControlMaster=auto",
+            "-o", "ControlPath={}".format(ssh_control_path),
+            "-o", "ControlPersist={}".format(ssh_persist)]
+
+
+def _ssh(host, remote_cmd):
+    return ["ssh"] + _ssh_opts() + [host, remote_cmd]
+
+
+def _scp(host, files):
+    return ["scp"] + _ssh_opts() + files + ["{}:".format(host)]
+
+
+def _remote(host, remote_cmd, retries=None):
+    cmd = _ssh(host, remote_cmd)
+
+    def once():
+        _log("will execute {}".format(cmd))
+        start = time.time()
+        exit_code = None
+        try:
+            exit_code = _run(cmd)
+        finally:
+            _record_ssh_time(host, time.time() - start)
+            _event("ssh", start, time.time() - start, exit_code, host=host, cmd=remote_cmd)
+        return exit_code
+
+    if _ssh_retry(host, once, retries) != 0:
+        raise Exception("Failed to execute cmd: {}".format(cmd))
+
+
+def _remote_output(host, remote_cmd):
+    if planning:
+        _plan_record(host, "ssh", remote_cmd, [("ssh version", [])])
+        return "{} {}\n".format(SCRIPT_VERSION, inventory_hash())
+    output = []
+
+    def once():
+        start = time.time()
+        exit_code = None
+        try:
+            proc = subprocess.run(_ssh(host, remote_cmd), stdout=subprocess.PIPE)
+            exit_code = proc.returncode
+            output[:] = [proc.stdout.decode("utf-8")]
+        finally:
+            _record_ssh_time(host, time.time() - start)
+            _event("ssh", start, time.time() - start, exit_code, host=host, cmd=remote_cmd)
+        return exit_code
+
+    if _ssh_retry(host, once) != 0:
+        raise Exception("Failed to execute {} at {}".format(remote_cmd, host))
+    return output[0]
+
+
+def _ssh_retry(host, fn, retries=None):
+    # fn() runs ssh and returns its exit code. 255 is returned by ssh itself
+    # when the connection could not be set up or broke, then fn is tried
+    # again with exponential backoff.
+    if retries is None:
+        retries = ssh_retries
+    delay = ssh_retry_delay
+    for attempt in range(retries + 1):
+        exit_code = fn()
+        if exit_code != 255 or attempt == retries:
+            return exit_code
+        _log("ssh connection to {} failed, retrying in {} sec ({}/{})".format(host, delay, attempt + 1, retries))
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+    return exit_code
+
+
+def _record_ssh_time(host, duration):
+    with _ssh_timings_lock:
+        _ssh_timings.setdefault(host, []).append(duration)
+
+
+def _report_ssh_timings():
+    # the first round trip to a host pays for tcp and ssh handshakes, the
+    # following ones reuse the master connection when multiplexing is on
+    for host in sorted(_ssh_timings):
+        times = _ssh_timings[host]
+        first = times[0]
+        if len(times) > 1:
+            rest = sum(times[1:]) / (len(times) - 1)
+            saved = max(first - rest, 0) * (len(times) - 1) if ssh_mux else 0
+            _log("ssh {}: {} calls, first {:.2f} sec, next {:.2f} sec avg, ~{:.1f} sec of handshakes saved".format(
+                host, len(times), first, rest, saved))
+        else:
+            _log("ssh {}: 1 call, {:.2f} sec".format(host, first))
+
+
+def _distribute(targets, fanout):
+    # copies the locally built debs of the modules of every host (host ->
+    # modules) to DEBS_DIST_DIR at the host. Hosts needing the same debs form
+    # a tree: the first `fanout` hosts get them from here and every host
+    # forwards them to `fanout` more over ssh, so the local uplink is used
+    # once per tree instead of once per host.
+    # Returns module -> path of its deb on the hosts, relative to the home dir.
+    debs = dict((m, _local_deb(m)) for m in set().union(*targets.values()))
+    groups = {}
+    for host in sorted(targets):
+        groups.setdefault(frozenset(targets[host]), []).append(host)
+    failed = set()
+    tasks = []
+    lock = threading.Lock()
+    start = time.time()
+
+    def send(src, i, hosts, files):
+        dst = hosts[i]
+        try:
+            _transfer(src, dst, files)
+        except Exception as e:
+            if src is not None:
+                _log("forwarding debs from {} to {} failed, sending them from here: {}".format(src, dst, e))
+                submit(None, i, hosts, files)
+                return
+            _log("ERROR: {}".format(e))
+            with lock:
+                failed.add(dst)
+        # hosts below a failed one get the debs from here
+        for c in range(fanout * (i + 1), min(fanout * (i + 2), len(hosts))):
+            submit(None if dst in failed else dst, c, hosts, files)
+
+    def submit(src, i, hosts, files):
+        with lock:
+            tasks.append(executor.submit(send, src, i, hosts, files))
+
+    with futures.ThreadPoolExecutor(max_workers=max(min(len(targets), _distribute_workers), 1)) as executor:
+        for (modules, hosts) in groups.items():
+            files = [debs[m] for m in sorted(modules)]
+            for i in range(min(fanout, len(hosts))):
+                submit(None, i, hosts, files)
+        # tasks add their children, wait until no new ones show up
+        done = 0
+        while True:
+            with lock:
+                waiting = tasks[done:]
+                done = len(tasks)
+            if not waiting:
+                break
+            futures.wait(waiting)
+
+    size = sum(_file_size(debs[m]) * len(hosts) for (modules, hosts) in groups.items() for m in modules)
+    _log("distributed {:.1f} MB to {} hosts in {:.1f} sec".format(size / 1e6, len(targets), time.time() - start))
+    if failed:
+        raise Exception("Failed to send debs to {}".format(" ".join(sorted(failed))))
+    return dict((m, "{}/{}".format(DEBS_DIST_DIR, os.path.basename(d))) for (m, d) in debs.items())
+
+
+# at most that many transfers of _distribute at the same time
+_distribute_workers = 32
+
+
+def _local_deb(module):
+    # the newest deb of the module built by publish
+    pattern = DEB_FILE.format(name=module, version="*")
+    debs = [d for p in _module_paths(module) for d in glob.glob(os.path.join(p, "target", pattern))]
+    if not debs and planning:
+        # the deb is built by the planned publish
+        return os.path.join(_module_paths(module)[0], "target", pattern)
+    if not debs:
+        raise Exception("no {} found, publish {} before distributing it".format(pattern, module))
+    return max(debs, key=os.path.getmtime)
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _transfer(src, dst, debs):
+    # sends debs to DEBS_DIST_DIR at dst, from here if src is None, else
+    # from src which got them before
+    names = [os.path.basename(d) for d in debs]
+    unpack = "mkdir -p {0} && tar -C {0} -xf -".format(DEBS_DIST_DIR)
+    size = sum(_file_size(d) for d in debs)
+
+    if planning:
+        _plan_record(dst, "ssh", "send {} from {}".format(" ".join(names), src or "here"), [("distribute", [])], 1 if src else 2)
+        return
+
+    def once():
+        start = time.time()
+        exit_code = None
+        try:
+            if src is None:
+                _log("will send {} to {}".format(" ".join(names), dst))
+                pack = ["tar", "-cf", "-"]
+                for d in debs:
+                    pack += ["-C", os.path.dirname(os.path.abspath(d)), os.path.basename(d)]
+                out = _current_log()
+                packer = subprocess.Popen(pack, stdout=subprocess.PIPE, stderr=out)
+                exit_code = subprocess.call(_ssh(dst, unpack), stdin=packer.stdout, stdout=out, stderr=out)
+                packer.stdout.close()
+                exit_code = exit_code or packer.wait()
+            else:
+                # the hop from src to dst authenticates with the forwarded agent
+                forward = "tar -C {} -cf - {} | ssh -o BatchMode=yes {} '{}'".format(DEBS_DIST_DIR, " ".join(names), dst, unpack)
+                cmd = ["ssh", "-A"] + _ssh_opts() + [src, forward]
+                _log("will execute {}".format(cmd))
+                exit_code = _run(cmd, tag=dst)
+        finally:
+            duration = time.time() - start
+            _record_ssh_time(src or dst, duration)
+            _event("distribute", start, duration, exit_code, host=dst, src=src or "local", bytes=size)
+        if exit_code == 0:
+            _log("{} -> {}: {:.1f} MB in {:.1f} sec, {:.1f} MB/s".format(
+                src or "local", dst, size / 1e6, duration, size / 1e6 / max(duration, 0.001)))
+        return exit_code
+
+    if _ssh_retry(dst, once) != 0:
+        raise Exception("Failed to send {} from {} to {}".format(" ".join(names), src or "here", dst))
+
+
+def _journal_file(run):
+    return os.path.join(cache_dir, "journal", "{}.jsonl".format(run))
+
+
+def _load_journal(run):
+    # (host, module, phase) -> time of the steps completed by the run, host or
+    # module is None for steps of a module or a host as a whole
+    path = _journal_file(run)
+    if not os.path.exists(path):
+        raise Exception("no journal of run {} at {}".format(run, path))
+    with open(path, 'r') as fin:
+        header = json.loads(fin.readline())
+        done = {}
+        for line in fin:
+            try:
+                step = json.loads(line)
+            except ValueError:
+                continue # the last line of a killed run can be cut off
+            done[(step["host"], step["module"], step["phase"])] = step["time"]
+    return (header, done)
+
+
+def _done(host, module, phase):
+    return (host, module, phase) in _journal_done
+
+
+def _journal(host, module, phase):
+    # appends a completed step to the journal of the run. It is on disk
+    # before the run moves on, so a crashed or failed run can be resumed.
+    global journal
+    with _journal_lock:
+        now = time.time()
+        _journal_done[(host, module, phase)] = now
+        _resumed_steps.discard((host, module, phase))
+        if remoteExec or events is None:
+            return
+        if journal is None:
+            journal = _open_journal()
+        journal.write(json.dumps({"host": host, "module": module, "phase": phase, "time": now}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def _open_journal():
+    path = _journal_file(journal_id)
+    _shared_dir(os.path.dirname(path), _shared_mode)
+    if not os.path.exists(path):
+        journals = sorted(glob.glob(os.path.join(os.path.dirname(path), "*.jsonl")), key=os.path.getmtime)
+        for old in journals[:max(len(journals) - _journal_keep + 1, 0)]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        with open(_shared_file(path, os.O_WRONLY | os.O_TRUNC), 'w') as fout:
+            json.dump({"run": journal_id, "cmd": sys.argv[1:]}, fout)
+            fout.write("\n")
+    return open(_shared_file(path), 'a')
+
+
+def _host_log_file(host):
+    return os.path.join(run_log_dir, "{}.log".format(host))
+
+
+def _open_run_log():
+    # every run logs to its own directory, so concurrent runs do not
+    # truncate each other's logs. Directories of runs which died are
+    # archived by the next run. A run claims such a directory by renaming it
+    # to <run>.archiving-<pid>, so each is archived once even if several runs
+    # start at the same time, and again if the archiving run dies as well.
+    for d in glob.glob(os.path.join(LOG_DIR, "*", "")):
+        name = os.path.basename(os.path.dirname(d))
+        (run, _, archiver) = name.partition(".archiving-")
+        if name.startswith("latest") or _pid_alive(int(archiver or run.rsplit("-", 1)[1])):
+            continue
+        claimed = os.path.join(LOG_DIR, "{}.archiving-{}".format(run, os.getpid()))
+        try:
+            os.rename(os.path.join(LOG_DIR, name), claimed)
+        except OSError:
+            continue
+        _archive_run(run, "interrupted", None, claimed)
+    _shared_dir(run_log_dir, _shared_mode)
+    with open(os.path.join(run_log_dir, "run.json"), 'w') as fout:
+        json.dump({"cmd": " ".join(sys.argv[1:]), "env": getattr(parsed, "env", None), "start": start}, fout)
+    latest = os.path.join(LOG_DIR, "latest")
+    tmp = "{}.{}".format(latest, os.getpid())
+    os.symlink(run_id, tmp)
+    os.replace(tmp, latest)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
 
-def _call(cmd):
+def _latest_run():
+    try:
+        return os.readlink(os.path.join(LOG_DIR, "latest"))
+    except OSError:
+        return None
+
+
+# tag of a log line, see _log and _output
+_log_tag = re.compile(rb"^(?:\d\d:\d\d:\d\d \S+: )?\[([^\]\s]+)\] ")
+
+
+def _archive_run(run, result, duration, run_dir=None):
+    # compresses the logs of the run into LOG_DIR/<run>.log.gz as gzip members:
+    # the main log, every host log and the lines of the main log tagged with a
+    # host or module. <run>.sections.json has offsets and lengths of the members
+    # of each section, so `log` decompresses only the section it prints.
+    run_dir = run_dir or os.path.join(LOG_DIR, run)
+    archive = os.path.join(LOG_DIR, run + ".log.gz")
+    sections = {}
+    tags = {}
+
+    def member(name, chunks):
+        start = fout.tell()
+        for chunk in chunks:
+            fout.write(chunk)
+        sections.setdefault(name, []).append([start, fout.tell() - start])
+
+    def compress(lines):
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for line in lines:
+            yield z.compress(line)
+        yield z.flush()
+
+    def split_tags(lines):
+        for line in lines:
+            m = _log_tag.match(line)
+            if m:
+                tag = m.group(1).decode("utf-8", "replace")
+                if tag not in tags:
+                    tags[tag] = (zlib.compressobj(6, zlib.DEFLATED, 31), [])
+                tags[tag][1].append(tags[tag][0].compress(line))
+            yield line
+
+    main = os.path.join(run_dir, "deploy.log")
+    with open(archive, 'wb') as fout:
+        if os.path.exists(main):
+            with open(main, 'rb') as fin:
+                member("", compress(split_tags(fin)))
+        for path in sorted(glob.glob(os.path.join(run_dir, "*.log"))):
+            if path != main:
+                with open(path, 'rb') as fin:
+                    member(os.path.basename(path)[:-len(".log")], compress(fin))
+        for (tag, (z, chunks)) in sorted(tags.items()):
+            member(tag, chunks + [z.flush()])
+    with open(os.path.join(LOG_DIR, run + ".sections.json"), 'w') as fout:
+        json.dump(sections, fout)
+
+    hosts = set(s for s in sections if s and os.path.exists(os.path.join(run_dir, s + ".log")))
+    if run == run_id:
+        hosts |= _run_hosts
+        modules = _run_modules
+    else:
+        modules = set(s for s in sections if s in topology.modules)
+    try:
+        with open(os.path.join(run_dir, "run.json"), 'r') as fin:
+            header = json.load(fin)
+    except (IOError, ValueError):
+        header = {"cmd": "", "env": None, "start": os.path.getmtime(run_dir)}
+    entry = dict(header, run=run, hosts=sorted(hosts), modules=sorted(modules), result=result,
+        duration=duration, size=os.path.getsize(archive))
+    _update_index(entry)
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def _read_index():
+    # entries of archived runs, oldest first
+    entries = []
+    try:
+        with open(os.path.join(LOG_DIR, "index.jsonl"), 'r') as fin:
+            for line in fin:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    return entries
+
+
+def _update_index(entry):
+    # adds the entry and drops the oldest runs until the history fits into
+    # LOG_HISTORY_SIZE MB
+    with open(_shared_file(os.path.join(LOG_DIR, "index.lock")), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = sorted(_read_index() + [entry], key=lambda e: e["start"])
+        size = sum(e["size"] for e in entries)
+        while size > LOG_HISTORY_SIZE * 1e6 and len(entries) > 1:
+            old = entries.pop(0)
+            size -= old["size"]
+            for suffix in [".log.gz", ".sections.json"]:
+                try:
+                    os.remove(os.path.join(LOG_DIR, old["run"] + suffix))
+                except OSError:
+                    pass
+        index = os.path.join(LOG_DIR, "index.jsonl")
+        tmp = "{}.{}".format(index, os.getpid())
+        with open(tmp, 'w') as fout:
+            for e in entries:
+                fout.write(json.dumps(e) + "\n")
+        os.replace(tmp, index)
+
+
+def _run_on_hosts(hosts, fn, parallel=1):
+    # runs fn(host) for every host using at most `parallel` workers.
+    # In parallel mode each host writes to its own log file, so output of
+    # different hosts is not interleaved in the main log.
+    separate_logs = parallel > 1
+    _plan_begin_stage(min(parallel, len(hosts)) if separate_logs else 1)
+    # every fn runs a plan, which needs the version of its host
+    _check_versions(hosts)
+    if separate_logs:
+        _log("running on {} hosts with {} workers".format(len(hosts), min(parallel, len(hosts))))
+        for h in hosts:
+            if h not in _host_logs:
+                _log("log of {} is {}".format(h, _host_log_file(h)))
+
+    def run(host):
+        return _on_host(host, fn, separate_logs)
+
+    if separate_logs:
+        with futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(run, hosts))
+    else:
+        results = []
+        for h in hosts:
+            results.append(run(h))
+            if results[-1][1]:
+                break
+
+    _print_summary(results)
+    failed = [h for (h, error, _) in results if error]
+    if failed:
+        raise Exception("Failed on hosts: {}".format(" ".join(failed)))
+    return results
+
+
+def _on_host(host, fn, separate_log):
+    # runs fn(host) with log messages tagged by the host and, if separate_log
+    # is set, command output going to the log file of the host.
+    # Returns (host, error, duration).
+    _local.host = host
+    # --plan runs write no logs
+    separate_log = separate_log and not planning
+    start = time.time()
+    error = None
+    try:
+        if separate_log:
+            # a run can go through the same host several times, its log is
+            # truncated only the first time
+            _local.log = open(_host_log_file(host), 'a' if host in _host_logs else 'w')
+            _host_logs.add(host)
+        with _Admission(["host:" + host]):
+            fn(host)
+    except Exception as e:
+        error = e
+        _log("ERROR: {}".format(e))
+    finally:
+        if getattr(_local, "log", None):
+            _local.log.close()
+            _local.log = None
+        _local.host = None
+    return (host, error, time.time() - start)
+
+
+class _Admission(object):
+    # holds hosts ("host:<name>") and RESOURCE_LIMITS resources while in the
+    # with block. deploy.py runs on this machine share their holds and waiting
+    # requests through LOCK_DIR. A request waits until all its names have a
+    # free slot. Waiting requests take their turn in order of how many holds
+    # their run already has, then of arrival, so a large run does not starve
+    # the small ones. A request holds nothing until it gets all its names, so
+    # requests can not deadlock.
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self.request = None
+        _run_hosts.update(n[len("host:"):] for n in self.names if n.startswith("host:"))
+
+    def __enter__(self):
+        if planning or not self.names:
+            return self
+        _hold_run_lock()
+        self.request = {"id": "{}-{}".format(run_id, id(self)), "run": run_id, "names": self.names,
+            "time": time.time(), "cmd": " ".join(sys.argv[1:])}
+        waiting = None
+        while True:
+            blockers = _admission_update(self._admit)
+            if blockers is None:
+                break
+            if waiting is None:
+                waiting = time.time()
+                _log("waiting for {} used by {}".format(" ".join(self.names),
+                    ", ".join("`{}` (run {})".format(cmd, run) for (run, cmd) in sorted(blockers))))
+            time.sleep(admission_poll)
+        if waiting is not None:
+            _log("got {} after {:.1f} sec".format(" ".join(self.names), time.time() - waiting))
+            _event("admission", waiting, time.time() - waiting, names=self.names)
+        return self
+
+    def __exit__(self, *exc):
+        if self.request:
+            _admission_update(lambda state: state["holds"].remove(next(r for r in state["holds"] if r["id"] == self.request["id"])))
+            self.request = None
+
+    def _admit(self, state):
+        # takes the slots of the request if it is its turn, otherwise
+        # returns (run, cmd) of the requests it waits for
+        if not any(r["id"] == self.request["id"] for r in state["waits"]):
+            state["waits"].append(self.request)
+        held = {}
+        used = {}
+        for r in state["holds"]:
+            held[r["run"]] = held.get(r["run"], 0) + 1
+            for n in r["names"]:
+                used.setdefault(n, []).append(r)
+        for r in sorted(state["waits"], key=lambda r: (held.get(r["run"], 0), r["time"])):
+            if r["id"] == self.request["id"]:
+                break
+            # an earlier request keeps its turn even while it waits itself
+            for n in r["names"]:
+                used.setdefault(n, []).append(r)
+        blockers = set()
+        for n in self.names:
+            limit = 1 if n.startswith("host:") else RESOURCE_LIMITS.get(n, 1)
+            if len(used.get(n, [])) >= limit:
+                blockers.update((r["run"], r["cmd"]) for r in used[n])
+        if blockers:
+            return blockers
+        state["waits"] = [r for r in state["waits"] if r["id"] != self.request["id"]]
+        state["holds"].append(self.request)
+        return None
+
+
+def _hold_run_lock():
+    # other runs take a run whose lock is free for dead and drop its requests
+    global _run_lock
+    with _run_lock_guard:
+        if _run_lock is None:
+            _shared_dir(os.path.join(LOCK_DIR, "runs"))
+            _run_lock = open(os.path.join(LOCK_DIR, "runs", run_id), 'w')
+            fcntl.flock(_run_lock, fcntl.LOCK_EX)
+            atexit.register(os.remove, _run_lock.name)
+
+
+def _shared_dir(path, mode=0o1777):
+    # creates path and its missing parents writable by all users, whatever
+    # the umask. Modes of directories created by other users are left alone.
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        _shared_dir(parent, mode)
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+    st = os.stat(path)
+    if st.st_uid == os.getuid() and st.st_mode & 0o7777 != mode:
+        os.chmod(path, mode)
+
+
+# LOG_DIR and cache_dir are shared like LOCK_DIR but without the sticky bit,
+# runs replace and drop the files of runs of other users there
+_shared_mode = 0o777
+
+
+def _shared_file(path, flags=os.O_WRONLY | os.O_APPEND):
+    # opens path, creating it writable by all users. Existing files are opened
+    # without O_CREAT, which fs.protected_regular denies for files of other
+    # users in sticky directories.
+    try:
+        return os.open(path, flags)
+    except FileNotFoundError:
+        fd = os.open(path, flags | os.O_CREAT, 0o666)
+    if os.fstat(fd).st_uid == os.getuid():
+        os.fchmod(fd, 0o666)
+    return fd
+
+
+def _run_alive(run):
+    try:
+        fin = open(os.path.join(LOCK_DIR, "runs", run), 'r')
+    except IOError:
+        return False
+    with fin:
+        try:
+            fcntl.flock(fin, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError:
+            return True
+    try:
+        os.remove(fin.name)
+    except OSError:
+        pass
+    return False
+
+
+def _admission_update(fn):
+    # runs fn(state) with the state of all runs locked and saves the state.
+    # LOCK_DIR is shared by users, so its files are written in place.
+    _shared_dir(LOCK_DIR)
+    with open(_shared_file(os.path.join(LOCK_DIR, "admission.json"), os.O_RDWR), 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = {"holds": [], "waits": []}
+        alive = {run_id: True}
+        for key in ["holds", "waits"]:
+            for r in state[key]:
+                if r["run"] not in alive:
+                    alive[r["run"]] = _run_alive(r["run"])
+            state[key] = [r for r in state[key] if alive[r["run"]]]
+        result = fn(state)
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+        f.flush()
+    return result
+
+
+def _print_summary(results):
+    if not results:
+        return
+    width = max(len(h) for (h, _, _) in results)
+    _log("{}  {:<6}  {}".format("host".ljust(width), "result", "time"))
+    for (host, error, duration) in results:
+        result = "failed" if error else "ok"
+        _log("{}  {:<6}  {:.1f} sec".format(host.ljust(width), result, duration))
+
+
+def _call(cmd, module=None):
     _log("will execute {}".format(cmd))
-    exit_code = subprocess.call(cmd, stdout=log, stderr=log)
+    start = time.time()
+    exit_code = _run(cmd, tag=module)
+    _event(os.path.basename(cmd[0]), start, time.time() - start, exit_code, module=module, cmd=" ".join(cmd))
     if exit_code != 0:
         raise Exception("Failed to execute cmd: {}".format(cmd))
 
+
+def _run(cmd, on_line=None, stdin=None, tag=None, timeout=None):
+    # runs cmd in its own event loop, so it is safe to call from host workers
+    if planning:
+        return _plan_run(cmd, on_line, stdin)
+    if tag is None:
+        tag = getattr(_local, "host", None)
+    return asyncio.run(_run_async(cmd, on_line, stdin, tag, timeout))
+
+
+async def _run_async(cmd, on_line=None, stdin=None, tag=None, timeout=None):
+    # streams stdout and stderr of cmd line by line to the log (and to the
+    # console in verbose or follow mode), each line prefixed with tag.
+    # on_line(line, stream) can consume a line by returning True.
+    # Returns the exit code, raises if cmd runs longer than timeout or cmd_timeout.
+    timeout = timeout or cmd_timeout
+    out = _current_log()
+    proc = await asyncio.create_subprocess_exec(*cmd,
+        stdin=subprocess.PIPE if stdin is not None else None,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, limit=1 << 20)
+
+    async def feed():
+        if stdin is not None:
+            proc.stdin.write(stdin.encode("utf-8"))
+            await proc.stdin.drain()
+            proc.stdin.close()
+
+    async def pump(stream, name):
+        async for raw in stream:
+            line = raw.decode("utf-8", "replace")
+            if on_line and on_line(line, name):
+                continue
+            _output(line, tag, out)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(feed(), pump(proc.stdout, "stdout"), pump(proc.stderr, "stderr")), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise Exception("Timed out after {} sec: {}".format(timeout, cmd))
+    return await proc.wait()
+
+
+def _output(line, tag, out):
+    if not line.endswith("\n"):
+        line = line + "\n"
+    if tag:
+        line = "[{}] {}".format(tag, line)
+    with _log_lock:
+        if out:
+            out.write(line)
+            out.flush()
+        if follow or not out:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+
+def _event(phase, start, duration, exit_code=0, host=None, module=None, **extra):
+    # appends a json line to events_file, `deploy.py log --stats` aggregates them
+    if module:
+        _run_modules.update(module.split())
+    if not events:
+        return
+    e = {"run": run_id, "phase": phase, "host": host or getattr(_local, "host", None), "module": module,
+         "start": start, "duration": duration, "exit_code": exit_code}
+    e.update(extra)
+    with _log_lock:
+        events.write(json.dumps(e) + "\n")
+        events.flush()
+
+
+def _open_events():
+    # rotates events_file to events_file.1 once it is larger than
+    # EVENTS_HISTORY_SIZE MB, runs still writing to it go on in the rotation
+    with open(_shared_file(events_file + ".lock"), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.getsize(events_file) > EVENTS_HISTORY_SIZE * 1e6:
+                os.replace(events_file, events_file + ".1")
+        except OSError:
+            pass
+        return open(_shared_file(events_file), 'a')
+
+
+def _read_events():
+    # events of the rotation and of the current file, oldest first
+    for path in [events_file + ".1", events_file]:
+        try:
+            with open(path, 'r') as fin:
+                for line in fin:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except IOError:
+            continue
+
+
+def _current_log():
+    return getattr(_local, "log", None) or log
+
+
 def _log(msg):
-    print(msg)
-    if log:
+    host = getattr(_local, "host", None)
+    if host:
+        msg = "[{}] {}".format(host, msg)
+    if not planning or verbose:
+        with _log_lock:
+            print(msg, flush=True)
+    out = _current_log()
+    if out:
         m = msg
         if not m.endswith("\n"):
             m = m + "\n"
 
         m = time.strftime('%X %x') + ": " + m
         
-        log.write(m)
+        with _log_lock:
+            out.write(m)
+            out.flush()
 
         
-def _sync_sources():
-    sync_cmd = ['rsync', '--delete', '--exclude=.**', '--exclude=target', '--exclude=logs', '--exclude=__pycache__', '-avzh', '.', "{}:{}".format(remoteHost, REPO_NAME)]
-    exit_code = subprocess.call(sync_cmd, stdout=log, stderr=log)
-    
+_sync_excludes = ["target", "logs", "__pycache__"]
+
+
+def _sync_sources(full=False):
+    # keeps an index of the files sent by the last sync to the host, so only
+    # files changed since then are transferred
+    index_file = os.path.join(cache_dir, "sync-{}-{}.json".format(remoteHost, os.path.basename(_build_workspace())))
+    try:
+        with open(index_file, 'r') as fin:
+            index = json.load(fin)
+    except (IOError, ValueError):
+        index = {}
+    if full:
+        index = {}
+
+    head = _git_head()
+    (files, changed) = _changed_files(index, head)
+    deleted = [f for f in index.get("files", {}) if f not in files]
+
+    sync_cmd = ['rsync', '-azh', '--stats']
+    if ssh_mux:
+        sync_cmd += ['-e', ' '.join(["ssh"] + _ssh_opts())]
+    start = time.time()
+    if "files" in index:
+        if not changed and not deleted:
+            _log("sources at {} are up to date".format(remoteHost))
+            return
+        _log("syncing {} changed and {} deleted files to {}".format(len(changed), len(deleted), remoteHost))
+        sync_cmd += ['--files-from=-', '--from0', '--delete-missing-args']
+        stdin = "\0".join(changed + deleted)
+    else:
+        _log("syncing all sources to {}".format(remoteHost))
+        sync_cmd += ['--delete', '--exclude=.**'] + ['--exclude={}'.format(e) for e in _sync_excludes]
+        stdin = None
+    sync_cmd += ['--rsync-path', "mkdir -p {} && rsync".format(_build_workspace())]
+    sync_cmd += ['.', "{}:{}".format(remoteHost, _build_workspace())]
+
+    _log("will execute {}".format(sync_cmd))
+    result = subprocess.run(sync_cmd, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    (_current_log() or sys.stdout).write(result.stdout)
+    _event("rsync", start, time.time() - start, result.returncode, host=remoteHost)
+    if result.returncode != 0:
+        raise Exception("Failed to sync sources to {}, rsync exit code {}".format(remoteHost, result.returncode))
+
+    duration = time.time() - start
+    sent = re.search(r"Total bytes sent: ([\d,.]+\w?)", result.stdout)
+    sent = sent.group(1) if sent else "?"
+    if "files" in index:
+        saved = index["full_sync_time"] - duration
+        _log("sent {} bytes in {:.1f} sec, ~{:.1f} sec saved compared to a full sync".format(sent, duration, saved))
+    else:
+        index["full_sync_time"] = duration
+        _log("sent {} bytes in {:.1f} sec".format(sent, duration))
+
+    index["files"] = files
+    index["head"] = head
+    _shared_dir(cache_dir, _shared_mode)
+    tmp = "{}.{}".format(index_file, os.getpid())
+    with open(tmp, 'w') as fout:
+        json.dump(index, fout)
+    os.replace(tmp, index_file)
+
+
+def _build_workspace():
+    # users build in separate checkouts, sharing compiled modules via build_cache
+    return BUILD_WORKSPACE.format(user=os.environ.get("DEPLOY_USER") or getpass.getuser())
+
+
+def _git_head():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _git_files(*args):
+    out = subprocess.check_output(["git"] + list(args) + ["-z"]).decode("utf-8")
+    return set(f for f in out.split("\0") if f)
+
+
+def _changed_files(index, head):
+    # returns (path -> [mtime, size, sha1] of all files to be synced, paths which
+    # differ from the index). In a git checkout files are listed by git and only
+    # files git reports as changed since the last synced commit get checked,
+    # otherwise the tree is walked and files with a new mtime or size are hashed.
+    old = index.get("files", {})
+    candidates = None
+    if head:
+        paths = _git_files("ls-files", "--cached", "--others", "--exclude-standard")
+        if index.get("head"):
+            try:
+                candidates = _git_files("diff", "--name-only", index["head"]) | \
+                    _git_files("ls-files", "--modified", "--others", "--exclude-standard")
+            except subprocess.CalledProcessError:
+                candidates = None
+    else:
+        paths = set()
+        for (root, dirs, names) in os.walk("."):
+            dirs[:] = [d for d in dirs if d not in _sync_excludes and not d.startswith(".")]
+            paths.update(os.path.relpath(os.path.join(root, n)) for n in names if not n.startswith("."))
+
+    files = {}
+    changed = []
+    for f in sorted(paths):
+        parts = f.split("/")
+        if any(p in _sync_excludes or p.startswith(".") for p in parts) or not os.path.isfile(f):
+            continue
+        prev = old.get(f)
+        if prev and candidates is not None and f not in candidates:
+            files[f] = prev
+            continue
+        st = os.stat(f)
+        if prev and prev[0] == st.st_mtime and prev[1] == st.st_size:
+            files[f] = prev
+            continue
+        digest = _tree_hash([f])
+        files[f] = [st.st_mtime, st.st_size, digest]
+        if not prev or prev[2] != digest:
+            changed.append(f)
+    return (files, changed)
 
 
 topParser = argparse.ArgumentParser()
 topParser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help = "do not redirect output to /dev/null")
 
+topParser.add_argument("--follow", dest="follow", action="store_true", help = "print output of commands to the console while writing it to the log")
+topParser.add_argument("--cmd-timeout", dest="cmd_timeout", type=int, default=None, metavar="SEC", help = "kill commands running longer than SEC seconds")
+topParser.add_argument("--docs-url", dest="docs_url", default=docs_url, metavar="URL", help = "base url of the docs server")
 topParser.add_argument("-r", "--remote", dest="remote", choices=["build00"], help = "execute all commands at the remote host")
+topParser.add_argument("--full-sync", dest="full_sync", action="store_true", help = "send the whole tree to the remote host instead of changed files only")
+topParser.add_argument("--build-cache", dest="build_cache", metavar="DIR",
+    help = "reuse compiled modules from DIR, keyed by hashes of their sources and dependencies. Defaults to {} with --remote".format(BUILD_CACHE_DIR))
+topParser.add_argument("--no-build-cache", dest="build_cache", action="store_const", const="", help = "build without the shared build cache")
+topParser.add_argument("--build-cache-size", dest="build_cache_size", type=float, default=BUILD_CACHE_SIZE, metavar="GB",
+    help = "evict least recently used entries of the build cache above GB gigabytes")
+topParser.add_argument("--version-cache-ttl", dest="version_cache_ttl", type=int, default=0, metavar="SEC", help = "trust script version checks of previous runs for SEC seconds")
+topParser.add_argument("--no-ssh-mux", dest="ssh_mux", action="store_false", help = "open a new ssh connection for every remote command")
+topParser.add_argument("--ssh-retries", dest="ssh_retries", type=int, default=3, metavar="N", help = "retry a remote command up to N times when its ssh connection fails")
+topParser.add_argument("--plan", dest="plan", action="store_true", help = "print the steps the command would run and estimate its time from past runs, without running anything")
+topParser.add_argument("--agent", dest="use_agent", action="store_true", help = "run plans by `deploy-target.py agent` on hosts running it instead of by new processes")
+topParser.add_argument("--resume", dest="resume", metavar="RUN_ID", help = "skip the steps which succeeded in the failed run RUN_ID")
 
 subParsers = topParser.add_subparsers(title = "Command categories")
 
 cleanParser = argparse.ArgumentParser(add_help = False)
 cleanParser.add_argument("-c", "--clean", dest="clean", action="store_true", help = "run `sbt clean` before building")
 
+batchParser = argparse.ArgumentParser(add_help = False)
+batchParser.add_argument("-b", "--batch", dest="batch", action="store_true", help = "run all sbt tasks in a single sbt session")
+
+forceParser = argparse.ArgumentParser(add_help = False)
+forceParser.add_argument("-f", "--force", dest="force", action="store_true", help = "publish modules even if they did not change since the last publish")
+
 noDocsParser = argparse.ArgumentParser(add_help = False)
 noDocsParser.add_argument("--no-docs", dest="no_docs", action="store_true", help = "skip docs publishing")
 
@@ -294,52 +2362,105 @@ updateParser = argparse.ArgumentParser(add_help = False)
 updateParser.add_argument("--no-update", dest="update", action="store_false", help = "do not run apt-get update before installing")
 updateParser.add_argument("--full-update", dest="full_update",  default=False, action="store_true", help = "run apt-get update from all sources before installing")
 
-startParser = subParsers.add_parser("start", description = "start backend module on local machine", parents = [cleanParser, modulesParser])
-startParser.add_argument("-t", "--hosttype", dest="hostType", default="local", help = "backend host type", choices=["local"])
-startParser.add_argument("-d", "--domain", dest="hostname", default="localhost", help = "akka hostname conf")
-startParser.set_defaults(func = start)
-
-
-shellParser = subParsers.add_parser("shell", description = "run shell command")
-shellParser.add_argument("cmd")
-shellParser.set_defaults(func = shell)
-
-
-installParser = subParsers.add_parser("install", description = "installing backend modules to host", 
-        parents = [modulesParser, groupsParser, hostParser, updateParser])
-installParser.add_argument("-r", "--restart", dest="restart", action="store_true", help = "restart service after installation")
-installParser.set_defaults(func = install)
-
-publishParser = subParsers.add_parser("publish", description = "publishing deb to nexus repo", parents = [modulesParser, hostParser, groupsParser, cleanParser, noDocsParser])
-publishParser.set_defaults(func = publish)
-
-chickParser = subParsers.add_parser("chick", description = "hubot chick dev", 
-        parents = [modulesParser, groupsParser, hostParser, cleanParser, updateParser, noDocsParser])
-chickParser.set_defaults(func = chick)
-
-deployParser = subParsers.add_parser("deploy", description = "deploy helper scripts to target", parents = [hostParser])
-deployParser.set_defaults(func = copy_scripts)
-
-deployDocsParser = subParsers.add_parser("publishdocs", description = "publish docs and api scheme", parents = [hostParser, cleanParser])
-deployDocsParser.set_defaults(func = publish_docs)
-
-restartParser = subParsers.add_parser("restart", description = "restart backend module", parents = [hostParser, modulesParser, groupsParser, actionParser])
-restartParser.set_defaults(func = restart_module)
-
-restartClusterParser = subParsers.add_parser("restartcluster", description = "start, stop backend", parents = [hostParser])
-restartClusterParser.set_defaults(func = restart_cluster)
+parallelParser = argparse.ArgumentParser(add_help = False)
+parallelParser.add_argument("-p", "--parallel", dest="parallel", type=int, default=1, metavar="N", help = "process up to N hosts at the same time")
+
+distributeParser = argparse.ArgumentParser(add_help = False)
+distributeParser.add_argument("--distribute", dest="distribute", action="store_true",
+    help = "send the locally built debs to the hosts, which forward them to each other over ssh, instead of installing from the repo")
+distributeParser.add_argument("--fanout", dest="fanout", type=int, default=3, metavar="N", help = "number of hosts every host forwards the debs to")
+
+def _start_command(p):
+    p.add_argument("-t", "--hosttype", dest="hostType", default="local", help = "backend host type", choices=["local"])
+    p.add_argument("-d", "--domain", dest="hostname", default="localhost", help = "akka hostname conf")
+    p.set_defaults(func = start)
+
+
+def _shell_command(p):
+    p.add_argument("cmd")
+    p.set_defaults(func = shell)
+    p.set_defaults(needs_sources = False)
+
+
+def _install_command(p):
+    p.add_argument("-r", "--restart", dest="restart", action="store_true", help = "restart service after installation")
+    p.add_argument("--version", dest="version", help = "install this version of the debs downloaded straight from the repo, skipping apt-get update")
+    p.set_defaults(func = install)
+
+
+def _positive_int(value):
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError("expected a positive number, got {}".format(value))
+    return int(value)
+
+
+def _restart_cluster_command(p):
+    p.add_argument("-p", "--parallel", dest="parallel", type=int, default=0, metavar="N", help = "restart up to N hosts at the same time, all by default")
+    p.add_argument("--rolling", dest="rolling", action="store_true", help = "restart hosts batch by batch while the others keep running")
+    p.add_argument("--batch-size", dest="batch_size", type=_positive_int, default=1, metavar="K", help = "hosts per batch in rolling mode")
+    p.set_defaults(func = restart_cluster)
+
+
+def _log_command(p):
+    p.add_argument("-t", "--target", dest="target", help = "print the log section of the target host, from the last run on it")
+    p.add_argument("-m", "--module", dest="module", help = "print the sbt output of the module, from the last run publishing it without --batch")
+    p.add_argument("--run", dest="run", metavar="RUN_ID", help = "print logs of the run RUN_ID instead of the last one")
+    p.add_argument("-l", "--list", dest="list", action="store_true", help = "list past runs, filtered by --target, --module, --env and --failed")
+    p.add_argument("-e", "--env", dest="env", help = "list runs in the environment only")
+    p.add_argument("--failed", dest="failed", action="store_true", help = "list failed runs only")
+    p.add_argument("-n", "--count", dest="count", type=int, default=20, help = "number of runs listed")
+    p.add_argument("--stats", dest="stats", action="store_true", help = "print the slowest phases and hosts of all logged runs")
+    p.add_argument("--top", dest="top", type=int, default=10, help = "number of rows in --stats tables")
+    p.set_defaults(func = print_log)
+    p.set_defaults(needs_sources = False)
+    p.set_defaults(verbose = True) # in non verbose mode logs will be cleaned up at the beginning
+
+
+def _defaults(func):
+    return lambda p: p.set_defaults(func = func)
+
+
+# (name, description, parents, function adding the rest of the arguments).
+# Only the parser of the command being run or completed is built.
+commands = [
+    ("start", "start backend module on local machine", [cleanParser, modulesParser], _start_command),
+    ("shell", "run shell command", [], _shell_command),
+    ("install", "installing backend modules to host",
+        [modulesParser, groupsParser, hostParser, updateParser, parallelParser, distributeParser], _install_command),
+    ("publish", "publishing deb to nexus repo",
+        [modulesParser, hostParser, groupsParser, cleanParser, batchParser, forceParser, noDocsParser], _defaults(publish)),
+    ("chick", "hubot chick dev",
+        [modulesParser, groupsParser, hostParser, cleanParser, batchParser, forceParser, updateParser, noDocsParser, parallelParser, distributeParser], _defaults(chick)),
+    ("deploy", "deploy helper scripts to target", [hostParser], _defaults(copy_scripts)),
+    ("publishdocs", "publish docs and api scheme", [hostParser, cleanParser, batchParser], _defaults(publish_docs)),
+    ("restart", "restart backend module", [hostParser, modulesParser, groupsParser, actionParser], _defaults(restart_module)),
+    ("restartcluster", "start, stop backend", [hostParser], _restart_cluster_command),
+    ("log", "print last deploy log to stdout", [], _log_command),
+]
+
+
+def _selected_command():
+    if "_ARGCOMPLETE" in os.environ:
+        line = os.environ.get("COMP_LINE", "")
+        words = line[:int(os.environ.get("COMP_POINT", len(line)))].split()[1:]
+    else:
+        words = sys.argv[1:]
+    names = [name for (name, _, _, _) in commands]
+    return next((w for w in words if w in names), None)
 
-logParser = subParsers.add_parser("log", description = "print last deploy log to stdout")
-logParser.set_defaults(func = print_log)
-logParser.set_defaults(verbose = True) # in non verbose mode logs will be cleaned up at the beginning
 
+selected = _selected_command()
+for (name, description, parents, build) in commands:
+    if name == selected:
+        build(subParsers.add_parser(name, description = description, parents = parents))
+    else:
+        subParsers.add_parser(name, description = description)
 
 
 try:
         import argcomplete
         argcomplete.autocomplete(topParser)
 except ImportError:
-        print("Try install python argcomplete :)")
         pass
 
 parsed = topParser.parse_args()
@@ -349,33 +2470,83 @@ try:
     if parsed.verbose:
         verbose = True
     else:
-        open(log_file, 'w').close() #clean up log file
-        log = open(log_file, 'a')
         verbose = False
+    planning = parsed.plan and not parsed.remote
+    if parsed.func != print_log and not planning:
+        _open_run_log()
+        if not verbose:
+            log = open(log_file, 'a')
+        events = _open_events()
+    follow = parsed.follow
+    docs_url = parsed.docs_url
+    cmd_timeout = parsed.cmd_timeout
+    ssh_mux = parsed.ssh_mux
+    version_cache_ttl = parsed.version_cache_ttl
+    ssh_retries = parsed.ssh_retries
+    use_agent = parsed.use_agent
+    build_cache = parsed.build_cache
+    build_cache_size = parsed.build_cache_size
+    if build_cache and not planning:
+        # dependencies resolved by sbt are shared as well, coursier keys them by url
+        coursier_cache = os.path.join(build_cache, "coursier")
+        try:
+            _shared_dir(coursier_cache, _build_cache_mode)
+        except OSError:
+            pass
+        if os.access(coursier_cache, os.W_OK):
+            os.environ.setdefault("COURSIER_CACHE", coursier_cache)
+        else:
+            _log("WARNING: {} is not writable, dependencies are resolved into the cache of the user".format(coursier_cache))
+    if parsed.resume and not parsed.remote:
+        (header, done) = _load_journal(parsed.resume)
+        _journal_done.update(done)
+        _resumed_steps.update(done)
+        journal_id = parsed.resume
+        _log("resuming run {} of `{}`, {} steps were done".format(journal_id, " ".join(header["cmd"]), len(done)))
     if parsed.remote:
         remoteExec = True
         remoteHost = parsed.remote
-        _sync_sources()
-
-        cmd = []
-        for a in sys.argv:
-          if a != "-r" and a != remoteHost:
-            cmd.append(a)
-        
-        cmd = ["'" + arg + "'" for arg in cmd]
-        cmd = ["cd", REPO_NAME, ";"] + cmd
-        c = ' '.join(cmd)
-        cmd = ["ssh", remoteHost, c]
-        _call(cmd)
+        # runs of the build host are limited by RESOURCE_LIMITS too
+        with _Admission(["build"] if getattr(parsed, "needs_sources", True) else []):
+            if getattr(parsed, "needs_sources", True):
+                _sync_sources(parsed.full_sync)
+
+            cmd = []
+            for a in sys.argv:
+              if a != "-r" and a != remoteHost:
+                cmd.append(a)
+            if parsed.build_cache is None:
+                cmd[1:1] = ["--build-cache", BUILD_CACHE_DIR]
+
+            # logs and caches of the run stay in the workspace of the user too
+            cmd = ["'" + arg + "'" for arg in cmd]
+            cmd = ["cd", _build_workspace(), ";", "mkdir", "-p", ".deploy-tmp", ";", "DEPLOY_TMP_DIR=$PWD/.deploy-tmp"] + cmd
+            c = ' '.join(cmd)
+            # the remote run is not repeated, it can be resumed from its journal
+            _remote(remoteHost, c, retries=0)
     else:
        parsed.func(parsed)
+       if planning:
+           _print_plan()
 except Exception as e:
     _log("ERROR: {}".format(e))
+    _close_agents()
+    if journal:
+        _log("add --resume {} to the same command to skip the steps which succeeded".format(journal_id))
+    _report_ssh_timings()
     end = time.time()
+    _event("run", start, end - start, 1, cmd=" ".join(sys.argv[1:]))
     _log("total time: {:.0f} sec".format(end - start))
+    if os.path.isdir(run_log_dir):
+        _archive_run(run_id, "failed", end - start)
     sys.exit(1)
 
+_close_agents()
+_report_ssh_timings()
 end = time.time()
+_event("run", start, end - start, cmd=" ".join(sys.argv[1:]))
 _log("total time: {:.0f} sec".format(end - start))
+if os.path.isdir(run_log_dir):
+    _archive_run(run_id, "ok", end - start)
 
 # vim: set tabstop=8 expandtab shiftwidth=4 softtabstop=4:
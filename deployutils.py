@@ -15,15 +15,49 @@
 # limitations under the License.
 
 import argparse
+import json
+import os
 import sys
-import itertools
 
 
-SCRIPT_VERSION = 1
+SCRIPT_VERSION = 10
 COMPANY_NAME = "company"
 MODULE_PREFIX = COMPANY_NAME
 DOMAIN = COMPANY_NAME + ".int"
 REPO_NAME = "repo-name"
+# logs, events and caches of deploy.py, DEPLOY_TMP_DIR keeps separate runs (e.g. benchmarks) apart
+TMP_DIR = os.environ.get("DEPLOY_TMP_DIR", "/tmp")
+CACHE_DIR = os.path.join(TMP_DIR, "{}-deploy-cache".format(COMPANY_NAME))
+# logs of the running runs, one directory each, and compressed logs of finished
+# runs listed in LOG_DIR/index.jsonl. LOG_DIR/latest names the last run.
+LOG_DIR = os.path.join(TMP_DIR, "{}-deploy-logs".format(COMPANY_NAME))
+# MB of compressed logs kept, the oldest runs are dropped first
+LOG_HISTORY_SIZE = 200
+# MB of events kept for `deploy.py log --stats` and plan estimates, when the
+# events file is larger it is rotated and the previous rotation dropped
+EVENTS_HISTORY_SIZE = 20
+# hosts and resources used by the deploy.py runs of all users on this machine
+LOCK_DIR = os.environ.get("DEPLOY_LOCK_DIR", "/tmp/{}-deploy-locks".format(COMPANY_NAME))
+# how many runs may use a resource at the same time, a host is used by one run at a time
+RESOURCE_LIMITS = {
+    "repo": 2,
+    "build": 1,
+    "docs": 1
+}
+# location of module debs in the company apt repo relative to its url
+DEB_FILE = "{name}_{version}_all.deb"
+DEB_POOL_PATH = "pool/{initial}/{name}/" + DEB_FILE
+# debs sent by `deploy.py install --distribute`, relative to the home dir on the hosts
+DEBS_DIST_DIR = "{}-debs".format(COMPANY_NAME)
+# socket of `deploy-target.py agent` on the hosts
+AGENT_SOCKET = "/run/{}-deploy-agent.sock".format(COMPANY_NAME)
+# checkout of each user on the build host of `deploy.py -r`, relative to the home dir
+BUILD_WORKSPACE = REPO_NAME + "-workspaces/{user}"
+# compiled modules and resolved dependencies shared by all workspaces of the build host.
+# Create it once as root, owned by a group of all deploying users with mode 2775.
+# Builds go on without the cache while it is not writable.
+BUILD_CACHE_DIR = "/var/cache/{}-build".format(COMPANY_NAME)
+BUILD_CACHE_SIZE = 20
 
 
 def _add_module_prefix(m):
@@ -36,22 +70,21 @@ def _add_module_prefix(m):
 def _remove_module_prefix(m):
     return m.replace(MODULE_PREFIX + "-", "")
 
+# topology used when there is no inventory file. It is private, deploy.py
+# and deploy-target.py read the loaded one through `topology`.
 _modules = ["bootstrap"]
 _seed_module = _add_module_prefix("bootstrap")
 
-tmodules = list(map(_add_module_prefix, _modules))
-modules = _modules + tmodules
-
-groups = {
-    "all": tmodules,
+_groups = {
+    "all": list(map(_add_module_prefix, _modules)),
     "seed": [],
     "main": list(map(_add_module_prefix, ["bootstrap"]))
 }
-hosts = [
+_hosts = [
     "backend00.dev.{}".format(DOMAIN)
 ]
 
-environments = {
+_environments = {
      "dev": [
         {
             "host": "backend00.dev.{}".format(DOMAIN),
@@ -61,12 +94,194 @@ environments = {
 }
 
 
+# source directories of modules, used to detect modules which did not change
+# since the last publish. Defaults to the module name without prefix, or to
+# the whole tree when there is no such directory.
+#   "company-bootstrap": ["bootstrap", "common"],
+module_sources = {}
+
+# readiness probes polled on the target after a module is started. Modules
+# without an entry are ready as soon as `service <module> status` succeeds.
+#   "company-bootstrap": {"type": "tcp", "port": 2551},
+#   "company-api": {"type": "http", "url": "http://localhost:8080/health"},
+#   "company-worker": {"type": "log", "path": "/var/log/company/worker.log", "pattern": "started"},
+# every probe also accepts "timeout" in seconds
+readiness = {}
+READINESS_TIMEOUT = 60
+# seconds waited after starting a seed module without a readiness probe,
+# `service <module> status` succeeds before the seed accepts connections
+SEED_START_DELAY = 3
+
+# modules which have to be ready before a module on the same host is started,
+# other modules of a host are started and stopped at the same time
+#   "company-api": ["company-bootstrap"],
+start_after = {}
+
+
+class Topology(object):
+    # hosts, environments, modules and groups with the indexes needed by
+    # deploy.py, so that lookups do not depend on the number of hosts
+
+    def __init__(self, modules, groups, environments, hosts=[]):
+        self.modules = [_add_module_prefix(m) for m in modules]
+        self.names = frozenset(self.modules + list(map(_remove_module_prefix, self.modules)))
+        self.groups = dict((g, [_add_module_prefix(m) for m in ms]) for (g, ms) in groups.items())
+        self.groups.setdefault("all", list(self.modules))
+        self.groups.setdefault("seed", [])
+        self.environments = dict((e, [{"host": s["host"], "modules": [_add_module_prefix(m) for m in s["modules"]]} for s in servers])
+                                 for (e, servers) in environments.items())
+        self.seed_modules = frozenset(self.groups["seed"])
+
+        # host -> stage, host -> modules, stage -> module -> hosts, seed hosts
+        self.stages = {}
+        self.host_modules = {}
+        self.module_hosts = {}
+        self.seed_hosts = set()
+        for (env, servers) in self.environments.items():
+            by_module = self.module_hosts.setdefault(env, {})
+            for server in servers:
+                host = server["host"]
+                self.stages[host] = env
+                self.host_modules[host] = frozenset(server["modules"])
+                for m in server["modules"]:
+                    by_module.setdefault(m, []).append(host)
+                if self.seed_modules & self.host_modules[host]:
+                    self.seed_hosts.add(host)
+        self.hosts = list(hosts) + [h for h in self.stages if h not in hosts]
+
+    def is_seed(self, host):
+        return host in self.seed_hosts
+
+    def targets(self, env, modules):
+        # host -> modules to be installed to the host. Seed hosts get all seed modules.
+        targets = {}
+        seeds = self.seed_modules & set(modules)
+        for m in modules:
+            for host in self.module_hosts.get(env, {}).get(m, []):
+                targets.setdefault(host, set()).add(m)
+        if seeds:
+            for host in self.seed_hosts:
+                if self.stages[host] == env:
+                    targets.setdefault(host, set()).update(seeds)
+        return targets
+
+
+def _inventory_file():
+    # DEPLOY_INVENTORY or inventory.{json,yaml,yml} next to this file
+    if os.environ.get("DEPLOY_INVENTORY"):
+        return os.environ["DEPLOY_INVENTORY"]
+    base = os.path.dirname(os.path.abspath(__file__))
+    for name in ["inventory.json", "inventory.yaml", "inventory.yml"]:
+        if os.path.exists(os.path.join(base, name)):
+            return os.path.join(base, name)
+    return None
+
+
+def inventory_target_name():
+    # targets find the inventory next to deploy-target.py, see _inventory_file
+    return "inventory" + os.path.splitext(_inventory_file())[1]
+
+
+_inventory_hash = {}
+
+
+def inventory_hash():
+    # targets with a different inventory get a new copy, see deploy.py _check_version
+    path = _inventory_file()
+    if not path:
+        return "-"
+    if path not in _inventory_hash:
+        import hashlib
+        with open(path, 'rb') as fin:
+            _inventory_hash[path] = hashlib.sha1(fin.read()).hexdigest()
+    return _inventory_hash[path]
+
+
+def load_topology(path):
+    # inventory format (json or yaml):
+    #   {"modules": ["bootstrap"], "groups": {"seed": ["bootstrap"]},
+    #    "environments": {"dev": [{"host": "backend00.dev", "modules": ["bootstrap"]}]},
+    #    "hosts": ["extra.host"]}
+    with open(path, 'r') as fin:
+        if path.endswith(".json"):
+            inventory = json.load(fin)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("install pyyaml to read {}".format(path))
+            inventory = yaml.safe_load(fin)
+    return Topology(inventory.get("modules", []), inventory.get("groups", {}),
+                    inventory.get("environments", {}), inventory.get("hosts", []))
+
+
+class _LazyTopology(object):
+    # loads the topology on first use, so tab completion and commands which
+    # do not need it do not pay for reading the inventory
+
+    def __getattr__(self, name):
+        if "_topology" not in self.__dict__:
+            if _inventory_file():
+                self.__dict__["_topology"] = load_topology(_inventory_file())
+            else:
+                self.__dict__["_topology"] = Topology(_modules, _groups, _environments, _hosts)
+            _write_completion_cache(self.__dict__["_topology"])
+        return getattr(self.__dict__["_topology"], name)
+
+
+topology = _LazyTopology()
+
+
 def is_seed(server):
-    return bool([m for m in server["modules"] if m in groups["seed"]])
+    return topology.is_seed(server["host"])
+
+
+def _completion_cache_key():
+    files = [os.path.abspath(__file__)] + ([_inventory_file()] if _inventory_file() else [])
+    return [[f, os.path.getmtime(f)] for f in files]
+
 
+def _write_completion_cache(t):
+    data = {"key": _completion_cache_key(), "modules": sorted(t.names), "groups": sorted(t.groups),
+            "hosts": t.hosts, "environments": sorted(t.environments)}
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            # shared by the runs of all users, see _shared_dir in deploy.py
+            os.makedirs(CACHE_DIR)
+            os.chmod(CACHE_DIR, 0o777)
+        tmp = os.path.join(CACHE_DIR, "completion.json.{}".format(os.getpid()))
+        with open(tmp, 'w') as fout:
+            json.dump(data, fout)
+        os.replace(tmp, os.path.join(CACHE_DIR, "completion.json"))
+    except OSError:
+        pass
 
-# mappings from hostname to stage
-stages = dict(itertools.chain.from_iterable(((hv["host"], en) for hv in ev) for (en, ev) in environments.items()))
+
+def _completion_data():
+    # names offered by the completers, read from a cache which is rewritten
+    # whenever this file or the inventory changes
+    try:
+        with open(os.path.join(CACHE_DIR, "completion.json"), 'r') as fin:
+            data = json.load(fin)
+        if data["key"] == _completion_cache_key():
+            return data
+    except (IOError, ValueError, KeyError):
+        pass
+    return {"modules": sorted(topology.names), "groups": sorted(topology.groups),
+            "hosts": topology.hosts, "environments": sorted(topology.environments)}
+
+
+class _Choices(object):
+    # choices of an argument evaluated on first use
+
+    def __init__(self, values):
+        self._values = values
+
+    def __contains__(self, value):
+        return value in self._values()
+
+    def __iter__(self):
+        return iter(self._values())
 
 
 def confirm(question, default="no"):
@@ -97,26 +312,34 @@ def ModuleCompleter(prefix, **kwargs):
     #warn("called with args: {}".format(kwargs))
     used = getattr(kwargs['parsed_args'], "modules", [])
     #warn("used = {}".format(used))
-    m = list(set(modules) - set(used) - set(map(_remove_module_prefix, used)))
+    m = list(set(_completion_data()["modules"]) - set(used) - set(map(_remove_module_prefix, used)))
     #warn("m = {}".format(m))
     return (v for v in m if v.startswith(prefix))
 
 
 def GroupCompleter(prefix, **kwargs):
     used = getattr(kwargs['parsed_args'], "groups", [])
-    m = list(set(groups.keys()) - set(used))
+    m = list(set(_completion_data()["groups"]) - set(used))
     return (v for v in m if v.startswith(prefix))
 
 
+def HostCompleter(prefix, **kwargs):
+    return (v for v in _completion_data()["hosts"] if v.startswith(prefix))
+
+
+def EnvironmentCompleter(prefix, **kwargs):
+    return (v for v in _completion_data()["environments"] if v.startswith(prefix))
+
+
 def _module_check(m):
-    if m not in modules:
+    if m not in topology.names:
         msg = "wrong module name: {}".format(m)
         raise argparse.ArgumentTypeError(msg)
     return _add_module_prefix(m)
 
 
 def _group_check(g):
-    if g not in groups.keys():
+    if g not in topology.groups:
         msg = "wrong group name: {}".format(g)
         raise argparse.ArgumentTypeError(msg)
     return g
@@ -145,12 +368,12 @@ hostParser = argparse.ArgumentParser(add_help=False)
 hostGroup = hostParser.add_mutually_exclusive_group()
 hostGroup.add_argument(
     "-t", "--target", dest="target", help="target host",
-    choices=hosts
-)
+    choices=_Choices(lambda: topology.hosts)
+).completer = HostCompleter
 hostGroup.add_argument(
     "-e", "--env", dest="env", default="dev", help="target environment",
-    choices=list(environments.keys())
-)
+    choices=_Choices(lambda: list(topology.environments))
+).completer = EnvironmentCompleter
 
 #vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 